@@ -0,0 +1,66 @@
+"""
+Compares filling templates with one str.replace per placeholder (how
+fill_template used to work) against a compiled template, as templates grow
+longer and get more placeholders. Run from madlibs_backend with
+
+    python -m benchmarks.fill_template
+"""
+
+import timeit
+from madlibs_module.madlibs_compiled_template import CompiledTemplate
+
+WORD_TYPES = ["noun", "verb", "adjective", "adverb", "place", "animal"]
+FILLER = "The quick brown fox jumps over the lazy dog. "
+
+
+def replace_fill(template, placeholder_words, user_inputs):
+    completed = template
+    for word, user_input in zip(placeholder_words, user_inputs):
+        completed = completed.replace(f"{{{word}}}", user_input, 1)
+    return completed
+
+
+def make_template(placeholders: int, filler_per_slot: int):
+    word_types = [
+        f"{WORD_TYPES[index % len(WORD_TYPES)]}_{index}"
+        for index in range(placeholders)
+    ]
+    template = "".join(
+        FILLER * filler_per_slot + f"{{{word_type}}} " for word_type in word_types
+    )
+    return template, word_types
+
+
+def best_of(fn, number: int) -> float:
+    """Fastest time per call in microseconds"""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print(
+        f"{'slots':>6} {'chars':>8} {'replace us':>11} {'compiled us':>12}"
+        f" {'speedup':>8} {'compile us':>11} {'bulk x100 us':>13}"
+    )
+    for placeholders in (5, 20, 100, 500):
+        for filler_per_slot in (1, 10):
+            template, word_types = make_template(placeholders, filler_per_slot)
+            words = [f"word{index}" for index in range(placeholders)]
+            compiled = CompiledTemplate.compile(template)
+            assert compiled.fill(words) == replace_fill(template, word_types, words)
+
+            number = max(10, 20000 // placeholders)
+            replace_us = best_of(
+                lambda: replace_fill(template, word_types, words), number
+            )
+            fill_us = best_of(lambda: compiled.fill(words), number)
+            compile_us = best_of(lambda: CompiledTemplate.compile(template), number)
+            bulk_us = best_of(lambda: compiled.fill_many([words] * 100), 10)
+            print(
+                f"{placeholders:>6} {len(template):>8} {replace_us:>11.1f}"
+                f" {fill_us:>12.1f} {replace_us / fill_us:>7.1f}x"
+                f" {compile_us:>11.1f} {bulk_us:>13.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
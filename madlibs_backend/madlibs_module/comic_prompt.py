@@ -19,3 +19,7 @@ class ComicPromptModule(dspy.Module):
     def forward(self, completed_madlibs):
         result = self.enhance_prompt(completed_madlibs=completed_madlibs)
         return result
+
+    async def aforward(self, completed_madlibs):
+        result = await self.enhance_prompt.acall(completed_madlibs=completed_madlibs)
+        return result
@@ -0,0 +1,157 @@
+from typing import Callable, Dict, Optional, Tuple
+import asyncio
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejectedException(Exception):
+    def __init__(self, reason: str):
+        super().__init__(f"Server is busy ({reason}), try again later")
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Caps one route at max_in_flight requests being handled, with at most
+    max_queued more waiting for a slot, none of them for longer than
+    max_queue_wait seconds. Anything beyond that is rejected straight away,
+    so requests that do get in see bounded latency instead of an ever
+    growing queue in front of a slow provider.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_in_flight: int,
+        max_queued: int,
+        max_queue_wait: float,
+    ):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_queue_wait = max_queue_wait
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed: Dict[str, int] = {"queue_full": 0, "queue_timeout": 0}
+
+    async def acquire(self) -> float:
+        """Take a slot, waiting if allowed; returns the seconds spent waiting"""
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()
+            self._admit()
+            return 0.0
+
+        if self.queued >= self.max_queued:
+            self._reject("queue_full")
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.max_queue_wait)
+        except asyncio.TimeoutError:
+            self._reject("queue_timeout")
+        finally:
+            self.queued -= 1
+        self._admit()
+        return time.perf_counter() - start
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def _admit(self):
+        self.in_flight += 1
+        self.admitted += 1
+
+    def _reject(self, reason: str):
+        self.shed[reason] += 1
+        logger.warning(f"Shedding {self.name} request: {reason}")
+        raise AdmissionRejectedException(reason)
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queued": self.max_queued,
+            "max_queue_wait": self.max_queue_wait,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+        }
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware putting an AdmissionController in front of each
+    (method, path) it is given. The slot is held until the response has been
+    sent in full, streams included. Rejected requests get a 503 with
+    Retry-After. on_result, if given, is called with (route, wait_seconds,
+    reason) for every admitted (reason None) or shed request.
+    """
+
+    def __init__(
+        self,
+        app,
+        controllers: Dict[Tuple[str, str], AdmissionController],
+        retry_after_seconds: int,
+        on_result: Optional[Callable[[str, float, Optional[str]], None]] = None,
+    ):
+        self.app = app
+        self.controllers = controllers
+        self.retry_after_seconds = retry_after_seconds
+        self.on_result = on_result
+
+    async def __call__(self, scope, receive, send):
+        controller = None
+        if scope["type"] == "http":
+            controller = self.controllers.get((scope["method"], scope["path"]))
+        if controller is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            wait = await controller.acquire()
+        except AdmissionRejectedException as e:
+            self._report(scope["path"], 0.0, e.reason)
+            _match_route(scope)
+            await self._reject(send, str(e))
+            return
+        self._report(scope["path"], wait, None)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release()
+
+    def _report(self, route: str, wait: float, reason: Optional[str]):
+        if self.on_result is not None:
+            self.on_result(route, wait, reason)
+
+    async def _reject(self, send, detail: str):
+        body = json.dumps({"detail": detail}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(self.retry_after_seconds).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def _match_route(scope):
+    # The router never sees a shed request; point scope at the route it would
+    # have matched so outer middleware still reports it under that route
+    for route in getattr(scope.get("app"), "routes", []):
+        if getattr(route, "path", None) == scope["path"] and scope["method"] in (
+            getattr(route, "methods", None) or ()
+        ):
+            scope["route"] = route
+            return
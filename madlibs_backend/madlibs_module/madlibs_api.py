@@ -1,14 +1,70 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
-from typing import List, Dict
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from dspy.streaming import StreamResponse
+from opentelemetry import trace
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import List, Dict, Literal, Optional, Tuple
+from contextlib import aclosing, asynccontextmanager
+import asyncio
+import dataclasses
+import dspy
+import hashlib
+import json
+import math
 import os
 import logging
+import time
 import uuid
-from pathlib import Path
-from madlibs_module.madlibs_generator import MadLibsGenerator
+from madlibs_module.madlibs_admission import AdmissionController, AdmissionMiddleware
+from madlibs_module.madlibs_compiled_template import (
+    CompiledTemplate,
+    TemplateCheck,
+    check_template,
+)
+from madlibs_module.madlibs_config import MadLibsConfig
+from madlibs_module.madlibs_disconnect import DisconnectMiddleware
+from madlibs_module.madlibs_executor import StageExecutor
+from madlibs_module.madlibs_idempotency import (
+    IdempotencyKeyReusedException,
+    IdempotencyStore,
+)
+from madlibs_module.madlibs_generator import MadLibsGenerator, MadlibsMismatchException
+from madlibs_module.madlibs_http import create_provider_http_client
 from madlibs_module.madlibs_image import MadLibsImage
+from madlibs_module.madlibs_image_cache import ImageCache
+from madlibs_module.madlibs_image_processing import (
+    MEDIA_TYPES,
+    ImageProcessor,
+    make_variant,
+    optimize_png,
+)
+from madlibs_module.madlibs_image_serving import (
+    HotImageCache,
+    ServedImage,
+    image_response,
+)
+from madlibs_module.madlibs_image_store import (
+    ImageStore,
+    InvalidImageNameException,
+    create_image_store,
+)
+from madlibs_module.madlibs_jobs import ImageJobQueue, JobQueueFullException
+from madlibs_module.madlibs_metrics import MadLibsMetrics, MetricsMiddleware
+from madlibs_module.madlibs_resilience import (
+    CircuitBreaker,
+    CircuitOpenException,
+    ProviderTimeoutException,
+    ResiliencePolicy,
+)
+from madlibs_module.madlibs_singleflight import SingleFlight
+from madlibs_module.madlibs_store import RecordStore, create_record_store
+from madlibs_module.madlibs_template_cache import TemplateCache, normalize_topic
+from madlibs_module.madlibs_tracing import (
+    configure_tracing,
+    current_trace_ref,
+    link_to_record,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +78,13 @@ class MadLibsTemplate(BaseModel):
     template: str
     word_types: List[str]
     topic: str
+    _compiled: Optional[CompiledTemplate] = PrivateAttr(default=None)
+
+
+class BatchTopicsRequest(BaseModel):
+    topics: List[str]
+    # How many templates to generate at once, capped by the server's limit
+    concurrency: Optional[int] = None
 
 
 class UserInputsRequest(BaseModel):
@@ -29,6 +92,16 @@ class UserInputsRequest(BaseModel):
     user_inputs: Dict[str, str]  # {word_type: user_input}
 
 
+class BulkFillRequest(BaseModel):
+    template_id: str
+    inputs: List[Dict[str, str]]  # [{word_type: user_input}, ...]
+
+
+class BulkFillResponse(BaseModel):
+    template_id: str
+    completed_texts: List[str]
+
+
 class CompletedMadLib(BaseModel):
     madlib_id: str
     completed_text: str
@@ -38,11 +111,113 @@ class CompletedMadLib(BaseModel):
 
 class ImageGenerationRequest(BaseModel):
     madlib_id: str
+    # Return 202 with a job id straight away instead of waiting for the image
+    job: bool = False
+
+
+class CompleteMadLibRequest(BaseModel):
+    topic: str
+    # One word per distinct word type of the template, in the order the types
+    # first appear; too few is a 422, extra words are ignored
+    words: List[str] = Field(..., min_length=1)
+    # Send each step as a server-sent event as soon as it is ready, so the
+    # text arrives long before the image
+    stream: bool = False
+
+
+class CompleteMadLibResponse(BaseModel):
+    template: MadLibsTemplate
+    madlib: CompletedMadLib
+    image_url: str
+    timings_ms: Dict[str, float]
+
+
+async def _timed(timings: Dict[str, float], stage: str, awaitable):
+    """Await something, recording how long it took under timings[stage]"""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        # Stop proxies from buffering the stream into one late response
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _drain(queue: asyncio.Queue, task: asyncio.Future):
+    """Yield what is put on queue until task finishes, then whatever is left"""
+    while True:
+        getter = asyncio.ensure_future(queue.get())
+        await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+        if not getter.done():
+            getter.cancel()
+            break
+        yield getter.result()
+    while not queue.empty():
+        yield queue.get_nowait()
+
+
+def _unoptimized_name(image_filename: str) -> str:
+    """Where a new image waits, as generated, for its background optimization"""
+    stem, _, extension = image_filename.rpartition(".")
+    return f"{stem}.unoptimized.{extension}"
+
+
+# Expensive routes and the admission control group each one counts against
+_ADMISSION_ROUTES = {
+    "/api/generate-template": "template",
+    "/api/generate-template/stream": "template",
+    "/api/generate-templates/batch": "batch",
+    "/api/submit-madlib": "submit",
+    "/api/submit-madlib/stream": "submit",
+    "/api/generate-image": "image",
+    "/api/madlib/complete": "complete",
+}
 
 
 class MadLibsAPI:
-    def __init__(self, api_key: str):
-        self.app = FastAPI(title="MadLibs API", version="0.0.1")
+    def __init__(self, api_key: str, config: Optional[MadLibsConfig] = None):
+        self.app = FastAPI(title="MadLibs API", version="0.0.1", lifespan=self.lifespan)
+        self.config = config or MadLibsConfig()
+        self.metrics = MadLibsMetrics()
+        if self.config.cancel_on_disconnect:
+            self.app.add_middleware(
+                DisconnectMiddleware,
+                routes={("POST", path) for path in _ADMISSION_ROUTES},
+                on_cancel=self.metrics.observe_disconnect,
+            )
+        # Added early so it sits inside CORS and metrics: shed requests still
+        # get CORS headers and are counted like any other response
+        self.admission: Dict[str, AdmissionController] = {}
+        admission_config = self.config.admission
+        if admission_config.enabled:
+            for group in set(_ADMISSION_ROUTES.values()):
+                limits = getattr(admission_config, group)
+                self.admission[group] = AdmissionController(
+                    group,
+                    max_in_flight=limits.max_in_flight,
+                    max_queued=limits.max_queued,
+                    max_queue_wait=limits.max_queue_wait,
+                )
+            self.app.add_middleware(
+                AdmissionMiddleware,
+                controllers={
+                    ("POST", path): self.admission[group]
+                    for path, group in _ADMISSION_ROUTES.items()
+                },
+                retry_after_seconds=admission_config.retry_after_seconds,
+                on_result=self.metrics.observe_admission,
+            )
         self.app.add_middleware(
             CORSMiddleware,
             allow_origins=["*"],  # In production, specify your frontend URL
@@ -50,153 +225,1324 @@ class MadLibsAPI:
             allow_methods=["*"],
             allow_headers=["*"],
         )
+        self.app.add_middleware(MetricsMiddleware, metrics=self.metrics)
         self.api_key = api_key
-        self.text_generator = MadLibsGenerator(api_key=self.api_key)
-        self.image_generator = MadLibsImage(api_key=self.api_key)
-        self.templates_store: Dict[str, dict] = {}
-        self.madlibs_store: Dict[str, dict] = {}
-        self.image_dir = Path("generated_images")
-        self.image_dir.mkdir(exist_ok=True)
+        self.tracer_provider = configure_tracing(self.config.tracing)
+        # Each provider-bound stage gets its own pool so a slow image call
+        # can't starve template generation, and none of them block the loop
+        stage_configs = {
+            "template": self.config.template_stage,
+            "comic_prompt": self.config.comic_stage,
+            "image": self.config.image_stage,
+        }
+        self.stages: Dict[str, StageExecutor] = {
+            name: StageExecutor(
+                name,
+                stage_config.max_workers,
+                observer=self.metrics.observe_stage,
+                max_concurrency=stage_config.max_concurrency,
+            )
+            for name, stage_config in stage_configs.items()
+        }
+        # Timeouts, retries, circuit breaking and hedging around each stage's
+        # provider calls
+        self.resilience: Dict[str, ResiliencePolicy] = {
+            name: ResiliencePolicy(
+                name,
+                timeout_seconds=stage_config.timeout_seconds,
+                retries=stage_config.retries,
+                backoff_base=stage_config.backoff_base,
+                backoff_max=stage_config.backoff_max,
+                breaker=CircuitBreaker(
+                    stage_config.failure_threshold, stage_config.reset_seconds
+                ),
+                hedge=stage_config.hedge,
+                hedge_min_delay=stage_config.hedge_min_delay,
+                on_event=self.metrics.observe_provider_event,
+            )
+            for name, stage_config in stage_configs.items()
+        }
+        # With async provider clients every call is a coroutine on the loop,
+        # and the image calls share one pool of kept-alive connections
+        self.provider_http = (
+            create_provider_http_client(
+                self.config.providers,
+                timeout=max(
+                    config.timeout_seconds for config in stage_configs.values()
+                ),
+            )
+            if self.config.providers.async_clients
+            else None
+        )
+        # Provider-side timeouts too, so abandoned calls free their thread
+        self.text_generator = MadLibsGenerator(
+            api_key=self.api_key,
+            timeout=max(
+                self.config.template_stage.timeout_seconds,
+                self.config.comic_stage.timeout_seconds,
+            ),
+            async_calls=self.provider_http is not None,
+        )
+        self.image_generator = MadLibsImage(
+            api_key=self.api_key,
+            timeout=self.config.image_stage.timeout_seconds,
+            http_client=self.provider_http,
+        )
+        self.templates_store: RecordStore = create_record_store(
+            self.config.store, "templates"
+        )
+        self.madlibs_store: RecordStore = create_record_store(
+            self.config.store, "madlibs"
+        )
+        self.image_store: ImageStore = create_image_store(self.config.images)
+        image_cache_config = self.config.image_cache
+        self.image_cache: Optional[ImageCache] = (
+            ImageCache(
+                image_cache_config.directory,
+                max_bytes=image_cache_config.max_bytes,
+            )
+            if image_cache_config.enabled
+            else None
+        )
+        serving_config = self.config.image_serving
+        self.hot_images: Optional[HotImageCache] = (
+            HotImageCache(serving_config.hot_cache_bytes)
+            if serving_config.hot_cache_bytes > 0
+            else None
+        )
+        self.image_processor = ImageProcessor(serving_config.processing_workers)
+        self.image_cache_control = (
+            f"public, max-age={serving_config.max_age_seconds}, immutable"
+        )
+        self.unoptimized_image_cache_control = (
+            f"public, max-age={self.config.image_optimize.unoptimized_max_age_seconds}"
+        )
+        comic_cache_config = self.config.comic_cache
+        self.comic_cache: Optional[RecordStore] = (
+            create_record_store(
+                dataclasses.replace(
+                    self.config.store,
+                    backend=comic_cache_config.backend,
+                    max_items=comic_cache_config.max_items,
+                    ttl_seconds=comic_cache_config.ttl_seconds,
+                ),
+                "comic_prompts",
+            )
+            if comic_cache_config.enabled
+            else None
+        )
+        cache_config = self.config.template_cache
+        self.template_cache: Optional[TemplateCache] = (
+            TemplateCache(
+                variants=cache_config.variants,
+                max_topics=cache_config.max_topics,
+                ttl_seconds=cache_config.ttl_seconds,
+                fuzzy=cache_config.fuzzy,
+                similarity_threshold=cache_config.similarity_threshold,
+            )
+            if cache_config.enabled
+            else None
+        )
+        # Identical calls that overlap share one provider call: templates by
+        # normalized topic, comic prompts and image prompts by hash, and
+        # image renders by madlib id
+        self.flights: Dict[str, SingleFlight] = {
+            name: SingleFlight(name, on_cancel=self.metrics.observe_cancelled_work)
+            for name in (
+                "template",
+                "comic_prompt",
+                "image",
+                "image_prompt",
+                "image_variant",
+            )
+        }
+        # Madlib ids whose image submit_madlib started on speculatively
+        self._speculative_images = set()
+        self.speculative_stats = {
+            "started": 0,
+            "attached": 0,
+            "cancelled": 0,
+            "failed": 0,
+        }
+        # Generated templates by what it took to make them usable
+        self.template_check_stats = {
+            "valid": 0,
+            "repaired": 0,
+            "regenerated": 0,
+            "failed": 0,
+        }
+        # Background re-encodes of freshly written images
+        self._optimizations = set()
+        self.optimization_stats = {
+            "palette": 0,
+            "lossless": 0,
+            "unchanged": 0,
+            "failed": 0,
+            "bytes_before": 0,
+            "bytes_after": 0,
+        }
+        idempotency_config = self.config.idempotency
+        self.idempotency: Optional[IdempotencyStore] = (
+            IdempotencyStore(
+                max_keys=idempotency_config.max_keys,
+                window_seconds=idempotency_config.window_seconds,
+            )
+            if idempotency_config.enabled
+            else None
+        )
+        jobs_config = self.config.image_jobs
+        self.image_jobs = ImageJobQueue(
+            handler=self._render_image,
+            workers=jobs_config.workers,
+            max_queue=jobs_config.max_queue,
+            retention_seconds=jobs_config.retention_seconds,
+            max_jobs=jobs_config.max_jobs,
+            store=create_record_store(self.config.store, "jobs"),
+        )
         self.setup_routes()
 
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        self.image_jobs.start()
+        self.image_processor.start()
+        yield
+        await self.image_jobs.stop()
+        for madlib_id in list(self._speculative_images):
+            self.flights["image"].cancel(madlib_id)
+        for task in list(self._optimizations):
+            task.cancel()
+        await self.image_jobs.store.close()
+        await self.templates_store.close()
+        await self.madlibs_store.close()
+        await self.image_store.close()
+        if self.image_cache is not None:
+            self.image_cache.close()
+        if self.comic_cache is not None:
+            await self.comic_cache.close()
+        for stage in self.stages.values():
+            stage.shutdown()
+        self.image_processor.shutdown()
+        if self.provider_http is not None:
+            await self.provider_http.aclose()
+        if self.tracer_provider is not None:
+            self.tracer_provider.force_flush()
+
     def setup_routes(self):
         self.app.get("/")(self.root)
         self.app.post("/api/generate-template")(self.generate_template)
+        self.app.post("/api/generate-template/stream")(self.generate_template_stream)
+        self.app.post("/api/generate-templates/batch")(self.generate_templates_batch)
         self.app.post("/api/submit-madlib")(self.submit_madlib)
+        self.app.post("/api/submit-madlib/stream")(self.submit_madlib_stream)
+        self.app.post("/api/fill-template/batch")(self.fill_template_batch)
+        self.app.post("/api/madlib/complete")(self.complete_madlib)
         self.app.post("/api/generate-image")(self.generate_image)
+        self.app.get("/api/jobs/{job_id}")(self.get_job)
         self.app.get("/api/images/{image_filename}")(self.get_image)
         self.app.get("/api/health")(self.health_check)
+        self.app.get("/metrics")(self.get_metrics)
 
     async def root(self):
         return {"message": "MadLibs API is Running!"}
 
-    async def generate_template(self, request: TopicRequest):
+    async def generate_template(
+        self, request: TopicRequest, idempotency_key: Optional[str] = Header(None)
+    ):
+        return await self._idempotent(
+            "generate-template",
+            idempotency_key,
+            request,
+            lambda: self._generate_template_response(request),
+        )
+
+    async def _generate_template_response(self, request: TopicRequest):
         try:
             logger.info(f"Generating template for topic: {request.topic}")
+            return await self._create_template(request.topic)
 
-            # Generate the template using your existing code
-            result = self.text_generator.madlibs_generator(request.topic)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error generating template: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+    async def generate_templates_batch(self, request: BatchTopicsRequest):
+        """
+        Generate a template per topic, several at a time, streaming each result
+        back as a line of NDJSON as soon as it finishes. A failed topic gets an
+        error line instead of failing the whole batch
+        """
+        batch_config = self.config.batch
+        if len(request.topics) > batch_config.max_topics:
+            raise HTTPException(
+                status_code=422,
+                detail=f"At most {batch_config.max_topics} topics per batch",
+            )
+        concurrency = min(
+            request.concurrency or batch_config.concurrency,
+            batch_config.max_concurrency,
+        )
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        logger.info(
+            f"Generating {len(request.topics)} templates, {concurrency} at a time"
+        )
 
-            # Create unique ID for this template
-            template_id = str(uuid.uuid4())
+        async def generate_one(index: int, topic: str) -> dict:
+            async with semaphore:
+                try:
+                    template = await self._create_template(topic)
+                    return {
+                        "index": index,
+                        "topic": topic,
+                        "status": "success",
+                        "template": template.model_dump(),
+                    }
+                except Exception as e:
+                    logger.error(f"Error generating template for {topic}: {str(e)}")
+                    return {
+                        "index": index,
+                        "topic": topic,
+                        "status": "error",
+                        "error": str(e),
+                    }
+
+        async def lines():
+            tasks = [
+                asyncio.create_task(generate_one(index, topic))
+                for index, topic in enumerate(request.topics)
+            ]
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    yield json.dumps(await finished) + "\n"
+            finally:
+                # The client went away; don't keep generating for nobody
+                for task in tasks:
+                    task.cancel()
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    async def _call_provider(self, stage: str, fn, afn, *args):
+        """
+        Run a provider call through its stage, under that stage's resilience
+        policy: the blocking fn on the stage's pool, or the async afn on the
+        loop when the async clients are on. An open circuit becomes a 503
+        with Retry-After and running out of time on every attempt a 504
+        """
+        if self.provider_http is not None:
+            run, fn = self.stages[stage].run_async, afn
+        else:
+            run = self.stages[stage].run
+        return await self._resilient(
+            stage, lambda on_start: run(fn, *args, on_start=on_start)
+        )
+
+    async def _stream_provider(self, stage: str, stream_fn, *args, on_token):
+        """
+        Run a streamed DSPy call the way _call_provider runs a normal one:
+        holding one of the stage's worker slots and under its resilience
+        policy, though with a single attempt since tokens already passed to
+        on_token can't be taken back. Returns the final prediction
+        """
+
+        async def stream(on_start):
+            result = None
+            async with self.stages[stage].slot(
+                blocking=self.provider_http is None, on_start=on_start
+            ):
+                async for value in stream_fn(*args):
+                    if isinstance(value, StreamResponse):
+                        on_token(value)
+                    elif isinstance(value, dspy.Prediction):
+                        result = value
+            return result
+
+        return await self._resilient(stage, stream, replayable=False)
+
+    async def _resilient(self, stage: str, fn, replayable: bool = True):
+        try:
+            return await self.resilience[stage].call(fn, replayable=replayable)
+        except CircuitOpenException as e:
+            raise HTTPException(
+                status_code=503,
+                detail=str(e),
+                headers={"Retry-After": str(max(math.ceil(e.retry_after), 1))},
+            )
+        except ProviderTimeoutException as e:
+            raise HTTPException(status_code=504, detail=str(e))
+
+    async def _create_template(self, topic: str) -> MadLibsTemplate:
+        cached = self._cached_template(topic)
+        if cached is not None:
+            return await self._store_template(topic, **cached)
+
+        checked = await self.flights["template"].do(
+            normalize_topic(topic), lambda: self._generate_template(topic)
+        )
+        return await self._store_template(
+            topic,
+            checked.template,
+            checked.word_types,
+            compiled=checked.compiled.to_dict(),
+        )
+
+    async def _generate_template(
+        self, topic: str, regenerations: Optional[int] = None
+    ) -> TemplateCheck:
+        # Generate the template using your existing code
+        generator = self.text_generator.madlibs_generator
+        if regenerations is None:
+            regenerations = self.config.template_regenerations
+        for attempt in range(regenerations + 1):
+            result = await self._call_provider(
+                "template", generator, generator.acall, topic
+            )
+            checked = self._check_template(result, attempt < regenerations)
+            if checked is not None:
+                break
+        self._cache_template(topic, checked)
+        return checked
 
-            # Store template data
-            self.templates_store[template_id] = {
-                "template": result.template,
-                "word_types": result.word_types,
-                "topic": request.topic,
-            }
+    async def _stream_template(self, topic: str, on_token) -> TemplateCheck:
+        result = await self._stream_provider(
+            "template", self.text_generator.stream_template, topic, on_token=on_token
+        )
+        regenerations = self.config.template_regenerations
+        checked = self._check_template(result, regenerations > 0)
+        if checked is None:
+            # Not streamed: the tokens sent so far were for the rejected one
+            return await self._generate_template(topic, regenerations - 1)
+        self._cache_template(topic, checked)
+        return checked
 
-            return MadLibsTemplate(
-                template_id=template_id,
-                template=result.template,
-                word_types=result.word_types,
-                topic=request.topic,
+    def _cache_template(self, topic: str, checked: TemplateCheck):
+        if self.template_cache is not None:
+            self.template_cache.add(
+                topic,
+                {
+                    "template": checked.template,
+                    "word_types": checked.word_types,
+                    "compiled": checked.compiled.to_dict(),
+                },
             )
 
+    def _check_template(self, result, can_regenerate: bool) -> Optional[TemplateCheck]:
+        """
+        Validate a generated template, repairing it locally where possible.
+        None means it has to be generated again
+        """
+        checked = check_template(result.template, result.word_types)
+        if checked.compiled is not None:
+            outcome = checked.result
+        elif can_regenerate:
+            logger.warning(f"Template could not be repaired: {result.template!r}")
+            outcome = "regenerated"
+        else:
+            outcome = "failed"
+        self.template_check_stats[outcome] += 1
+        self.metrics.observe_template_check(outcome)
+        if outcome == "failed":
+            raise MadlibsMismatchException("Generated template could not be repaired")
+        return checked if checked.compiled is not None else None
+
+    def _cached_template(self, topic: str) -> Optional[dict]:
+        if self.template_cache is None:
+            return None
+        cached = self.template_cache.lookup(topic)
+        if cached is not None:
+            logger.info(f"Using cached template for topic: {topic}")
+        return cached
+
+    async def generate_template_stream(self, request: TopicRequest):
+        """
+        Same as generate_template, but streams the template text as server-sent
+        events while the LM writes it, ending with a "result" event that carries
+        the usual MadLibsTemplate payload
+        """
+        logger.info(f"Streaming template for topic: {request.topic}")
+
+        async def events():
+            work = None
+            try:
+                cached = self._cached_template(request.topic)
+                if cached is not None:
+                    template = await self._store_template(request.topic, **cached)
+                    yield _sse_event("result", template.model_dump())
+                    return
+
+                # Coalesced like generate_template: a request already making
+                # a template for this topic is waited on, without tokens
+                tokens = asyncio.Queue()
+                work = asyncio.ensure_future(
+                    self.flights["template"].do(
+                        normalize_topic(request.topic),
+                        lambda: self._stream_template(request.topic, tokens.put_nowait),
+                    )
+                )
+                async for value in _drain(tokens, work):
+                    yield _sse_event(
+                        "token",
+                        {"field": value.signature_field_name, "chunk": value.chunk},
+                    )
+                checked = await work
+                template = await self._store_template(
+                    request.topic,
+                    checked.template,
+                    checked.word_types,
+                    compiled=checked.compiled.to_dict(),
+                )
+                yield _sse_event("result", template.model_dump())
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                logger.error(f"Error streaming template: {detail}")
+                yield _sse_event("error", {"detail": detail})
+            finally:
+                if work is not None:
+                    work.cancel()
+
+        return _sse_response(events())
+
+    async def _store_template(
+        self,
+        topic: str,
+        template: str,
+        word_types: List[str],
+        compiled: Optional[dict] = None,
+    ) -> MadLibsTemplate:
+        """
+        Save a template under a new id, along with its compiled form so it
+        isn't parsed again for every fill
+        """
+        if compiled is None:
+            compiled = CompiledTemplate.compile(template).to_dict()
+
+        # Create unique ID for this template
+        template_id = str(uuid.uuid4())
+
+        # Store template data
+        trace.get_current_span().set_attribute("madlibs.template_id", template_id)
+        await self.templates_store.put(
+            template_id,
+            {
+                "template": template,
+                "word_types": word_types,
+                "compiled": compiled,
+                "topic": topic,
+                "trace": current_trace_ref(),
+            },
+        )
+
+        stored = MadLibsTemplate(
+            template_id=template_id,
+            template=template,
+            word_types=word_types,
+            topic=topic,
+        )
+        stored._compiled = CompiledTemplate.from_dict(compiled)
+        return stored
+
+    async def submit_madlib(
+        self, request: UserInputsRequest, idempotency_key: Optional[str] = Header(None)
+    ):
+        return await self._idempotent(
+            "submit-madlib",
+            idempotency_key,
+            request,
+            lambda: self._submit_madlib(request),
+        )
+
+    async def _submit_madlib(self, request: UserInputsRequest):
+        try:
+            completed_madlib = await self._fill_madlib(request)
+            madlib_id = str(uuid.uuid4())
+            self._start_speculative_image(madlib_id, completed_madlib)
+
+            try:
+                comic_result = await self._generate_comic_prompt(completed_madlib)
+            except BaseException:
+                self._cancel_speculative_image(madlib_id)
+                raise
+            return await self._store_madlib(madlib_id, completed_madlib, comic_result)
+
+        except HTTPException:
+            raise
         except Exception as e:
-            logger.error(f"Error generating template: {str(e)}")
+            logger.error(f"Error completing madlib: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
-    async def submit_madlib(self, request: UserInputsRequest):
-        try:
-            # Retrieve template
-            if request.template_id not in self.templates_store:
-                raise HTTPException(status_code=404, detail="Template not found")
+    async def submit_madlib_stream(self, request: UserInputsRequest):
+        """
+        Same as submit_madlib, but sends the completed text straight away and
+        then streams the comic prompt fields as server-sent events, ending
+        with a "result" event that carries the usual CompletedMadLib payload
+        """
+        completed_madlib = await self._fill_madlib(request)
+        madlib_id = str(uuid.uuid4())
 
-            template_data = self.templates_store[request.template_id]
+        async def events():
+            self._start_speculative_image(madlib_id, completed_madlib)
+            stored = False
+            work = None
+            yield _sse_event("completed_text", {"completed_text": completed_madlib})
+            try:
+                cache_key, result = await self._cached_comic_prompt(completed_madlib)
+                if result is None:
+                    # Coalesced like submit_madlib, by the completed text
+                    tokens = asyncio.Queue()
+                    work = asyncio.ensure_future(
+                        self.flights["comic_prompt"].do(
+                            cache_key
+                            or self.text_generator.comic_prompt_cache_key(
+                                completed_madlib
+                            ),
+                            lambda: self._stream_comic_prompt(
+                                completed_madlib, cache_key, tokens.put_nowait
+                            ),
+                        )
+                    )
+                    async for value in _drain(tokens, work):
+                        yield _sse_event(
+                            "token",
+                            {"field": value.signature_field_name, "chunk": value.chunk},
+                        )
+                    result = await work
+                madlib = await self._store_madlib(madlib_id, completed_madlib, result)
+                stored = True
+                yield _sse_event("result", madlib.model_dump())
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                logger.error(f"Error streaming comic prompt: {detail}")
+                yield _sse_event("error", {"detail": detail})
+            finally:
+                if work is not None:
+                    work.cancel()
+                # Nobody can ask for the image of a madlib that was never stored
+                if not stored:
+                    self._cancel_speculative_image(madlib_id)
 
-            # Convert user inputs to list in correct order
-            user_inputs_list = [
-                request.user_inputs.get(word_type, "")
-                for word_type in template_data["word_types"]
-            ]
+        return _sse_response(events())
+
+    async def _generate_comic_prompt(self, completed_madlib: str):
+        cache_key, comic_result = await self._cached_comic_prompt(completed_madlib)
+        if comic_result is not None:
+            return comic_result
+
+        return await self.flights["comic_prompt"].do(
+            cache_key or self.text_generator.comic_prompt_cache_key(completed_madlib),
+            lambda: self._run_comic_prompt(completed_madlib, cache_key),
+        )
+
+    async def _run_comic_prompt(self, completed_madlib: str, cache_key: Optional[str]):
+        # Generate comic prompt
+        generator = self.text_generator.comicprompt_generator
+        comic_result = await self._call_provider(
+            "comic_prompt", generator, generator.acall, completed_madlib
+        )
+        await self._cache_comic_prompt(cache_key, comic_result)
+        return comic_result
 
-            # Fill the template =========================================== FIX???
-            completed_madlib = self.text_generator.fill_template(
-                template=template_data["template"],
-                placeholder_words=template_data["word_types"],
-                user_inputs=user_inputs_list,
+    async def _stream_comic_prompt(
+        self, completed_madlib: str, cache_key: Optional[str], on_token
+    ):
+        comic_result = await self._stream_provider(
+            "comic_prompt",
+            self.text_generator.stream_comic_prompt,
+            completed_madlib,
+            on_token=on_token,
+        )
+        await self._cache_comic_prompt(cache_key, comic_result)
+        return comic_result
+
+    async def _cached_comic_prompt(self, completed_madlib: str):
+        """The cache key for a completed madlib and its cached comic prompt, if any"""
+        if self.comic_cache is None:
+            return None, None
+        cache_key = self.text_generator.comic_prompt_cache_key(completed_madlib)
+        cached = await self.comic_cache.get(cache_key)
+        if cached is None:
+            return cache_key, None
+        logger.info("Using cached comic prompt")
+        return cache_key, dspy.Prediction(**cached)
+
+    async def _cache_comic_prompt(self, cache_key: Optional[str], comic_result):
+        if cache_key is not None:
+            await self.comic_cache.put(
+                cache_key,
+                {
+                    "comic_prompt": comic_result.comic_prompt,
+                    "panel_suggestions": comic_result.panel_suggestions,
+                },
             )
 
-            # Generate comic prompt
-            comic_result = self.text_generator.comicprompt_generator(completed_madlib)
+    async def fill_template_batch(self, request: BulkFillRequest):
+        """
+        Fill one stored template with many sets of words at once, without
+        storing the results or making comic prompts for them
+        """
+        max_fills = self.config.batch.max_fills
+        if len(request.inputs) > max_fills:
+            raise HTTPException(
+                status_code=422,
+                detail=f"At most {max_fills} input sets per request",
+            )
+        try:
+            compiled = await self._compiled_template(request.template_id)
+            with self.metrics.time_stage("fill_template_batch"):
+                completed_texts = compiled.fill_many(
+                    [
+                        [user_inputs.get(slot, "") for slot in compiled.slots]
+                        for user_inputs in request.inputs
+                    ]
+                )
+            return BulkFillResponse(
+                template_id=request.template_id, completed_texts=completed_texts
+            )
 
-            # Store completed madlib
-            madlib_id = str(uuid.uuid4())
-            self.madlibs_store[madlib_id] = {
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error filling template: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+    async def _compiled_template(self, template_id: str) -> CompiledTemplate:
+        template_data = await self.templates_store.get(template_id)
+        if template_data is None:
+            raise HTTPException(status_code=404, detail="Template not found")
+        link_to_record(template_data, template_id=template_id)
+
+        # Records saved before templates were compiled only have the text
+        if "compiled" in template_data:
+            return CompiledTemplate.from_dict(template_data["compiled"])
+        return CompiledTemplate.compile(template_data["template"])
+
+    async def _fill_madlib(self, request: UserInputsRequest) -> str:
+        compiled = await self._compiled_template(request.template_id)
+        with self.metrics.time_stage("fill_template"):
+            return compiled.fill(
+                [request.user_inputs.get(slot, "") for slot in compiled.slots]
+            )
+
+    async def _store_madlib(
+        self, madlib_id: str, completed_madlib: str, comic_result
+    ) -> CompletedMadLib:
+        # Store completed madlib
+        trace.get_current_span().set_attribute("madlibs.madlib_id", madlib_id)
+        await self.madlibs_store.put(
+            madlib_id,
+            {
                 "completed_text": completed_madlib,
                 "comic_prompt": comic_result.comic_prompt,
                 "panel_suggestions": comic_result.panel_suggestions,
-            }
+                "trace": current_trace_ref(),
+            },
+        )
 
-            return CompletedMadLib(
-                madlib_id=madlib_id,
-                completed_text=completed_madlib,
-                comic_prompt=comic_result.comic_prompt,
-                panel_suggestions=comic_result.panel_suggestions,
-            )
+        return CompletedMadLib(
+            madlib_id=madlib_id,
+            completed_text=completed_madlib,
+            comic_prompt=comic_result.comic_prompt,
+            panel_suggestions=comic_result.panel_suggestions,
+        )
+
+    async def complete_madlib(
+        self,
+        request: CompleteMadLibRequest,
+        idempotency_key: Optional[str] = Header(None),
+    ):
+        if request.stream:
+            # A stream can't be replayed, so streamed requests always run
+            return await self._complete_madlib(request)
+        return await self._idempotent(
+            "madlib-complete",
+            idempotency_key,
+            request,
+            lambda: self._complete_madlib(request),
+        )
+
+    async def _complete_madlib(self, request: CompleteMadLibRequest):
+        """
+        Run the whole flow in one call: generate a template for the topic,
+        fill it with the given words, then produce the comic prompt and the
+        image at the same time. With stream=true every step goes out as a
+        server-sent event as soon as it is done, ending with a "result" event
+        """
+        logger.info(f"Completing madlib for topic: {request.topic}")
+        if request.stream:
+
+            async def events():
+                try:
+                    async for event, data in self._complete_madlib_steps(request):
+                        yield _sse_event(event, data)
+                except Exception as e:
+                    detail = e.detail if isinstance(e, HTTPException) else str(e)
+                    logger.error(f"Error streaming madlib: {detail}")
+                    yield _sse_event("error", {"detail": detail})
+
+            return _sse_response(events())
 
+        try:
+            async with aclosing(self._complete_madlib_steps(request)) as steps:
+                async for event, data in steps:
+                    if event == "result":
+                        return data
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error completing madlib: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
-    async def generate_image(self, request: ImageGenerationRequest):
-        try:
-            # Retrieve madlib data
-            if request.madlib_id not in self.madlibs_store:
-                raise HTTPException(status_code=404, detail="MadLib not found")
+    async def _complete_madlib_steps(self, request: CompleteMadLibRequest):
+        """Yield (event, data) for each step of complete_madlib as it finishes"""
+        timings: Dict[str, float] = {}
+        start = time.perf_counter()
 
-            madlib_data = self.madlibs_store[request.madlib_id]
+        template = await _timed(
+            timings, "template", self._create_template(request.topic)
+        )
+        yield "template", template.model_dump()
 
-            # Generate image
-            logger.info("Generating image...")
+        fill_start = time.perf_counter()
+        compiled = template._compiled
+        # One word per word type, like the user_inputs of submit_madlib, so a
+        # type used twice gets the same word both times
+        word_types = list(dict.fromkeys(compiled.slots))
+        if len(request.words) < len(word_types):
+            raise HTTPException(
+                status_code=422,
+                detail=(
+                    f"The template needs {len(word_types)} words "
+                    f"({', '.join(word_types)}) but {len(request.words)} were sent"
+                ),
+            )
+        with self.metrics.time_stage("fill_template"):
+            completed_madlib = compiled.fill(dict(zip(word_types, request.words)))
+        timings["fill_template"] = round((time.perf_counter() - fill_start) * 1000, 1)
+        yield "completed_text", {"completed_text": completed_madlib}
 
-            # Modify the image generator to save with unique filename
-            image_filename = f"{request.madlib_id}.png"
-            image_path = self.image_dir / image_filename
+        # The image only needs the completed text, so it runs alongside the
+        # comic prompt rather than after it
+        madlib_id = str(uuid.uuid4())
+        image_task = asyncio.create_task(
+            _timed(
+                timings,
+                "image",
+                self.flights["image"].do(
+                    madlib_id, lambda: self._image_for(madlib_id, completed_madlib)
+                ),
+            )
+        )
+        try:
+            comic_result = await _timed(
+                timings, "comic_prompt", self._generate_comic_prompt(completed_madlib)
+            )
+            madlib = await self._store_madlib(madlib_id, completed_madlib, comic_result)
+            yield "madlib", madlib.model_dump()
 
-            # We need to modify the generate method to return the image path
-            # For now, we'll use the existing method and assume it saves to a fixed location
-            self.image_generator.generate(madlib_data["completed_text"])
+            image = await image_task
+            yield "image", image
+        finally:
+            image_task.cancel()
 
-            # Move the generated image to our storage location
-            import shutil
+        timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+        yield "result", CompleteMadLibResponse(
+            template=template,
+            madlib=madlib,
+            image_url=image["image_url"],
+            timings_ms=timings,
+        ).model_dump()
 
-            if os.path.exists("gemini-native-image.png"):
-                shutil.move("gemini-native-image.png", str(image_path))
+    async def generate_image(
+        self,
+        request: ImageGenerationRequest,
+        idempotency_key: Optional[str] = Header(None),
+    ):
+        return await self._idempotent(
+            "generate-image",
+            idempotency_key,
+            request,
+            lambda: self._generate_image(request),
+        )
+
+    async def _generate_image(self, request: ImageGenerationRequest):
+        if await self.madlibs_store.get(request.madlib_id) is None:
+            raise HTTPException(status_code=404, detail="MadLib not found")
 
-            return {
-                "madlib_id": request.madlib_id,
-                "image_url": f"/api/images/{image_filename}",
-                "status": "success",
-            }
+        if request.job:
+            try:
+                job = await self.image_jobs.submit(request.madlib_id)
+            except JobQueueFullException as e:
+                raise HTTPException(status_code=503, detail=str(e))
+            status_url = f"/api/jobs/{job.job_id}"
+            return JSONResponse(
+                status_code=202,
+                content={**job.to_dict(), "status_url": status_url},
+                headers={"Location": status_url},
+            )
 
+        try:
+            return await self._render_image(request.madlib_id)
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error generating image: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
-    async def get_image(self, image_filename: str):
+    async def _render_image(self, madlib_id: str) -> dict:
+        """
+        Generate the image for a stored madlib. Shared by the synchronous
+        endpoint and the job queue workers
+        """
+        if madlib_id in self._speculative_images:
+            # submit_madlib already started on it; just wait for that to land
+            logger.info("Attaching to speculative image generation")
+            self.speculative_stats["attached"] += 1
+        return await self.flights["image"].do(
+            madlib_id, lambda: self._render_stored_image(madlib_id)
+        )
+
+    async def _render_stored_image(self, madlib_id: str) -> dict:
+        madlib_data = await self.madlibs_store.get(madlib_id)
+        if madlib_data is None:
+            raise HTTPException(status_code=404, detail="MadLib not found")
+        link_to_record(madlib_data, madlib_id=madlib_id)
+
+        image_filename = f"{madlib_id}.png"
+        exists = self.image_store.exists
+        if await exists(image_filename) or await exists(
+            _unoptimized_name(image_filename)
+        ):
+            return self._image_result(madlib_id)
+        return await self._image_for(madlib_id, madlib_data["completed_text"])
+
+    async def _image_for(self, madlib_id: str, completed_text: str) -> dict:
+        prompt_key = ImageCache.key_for(
+            self.image_generator.model,
+            self.image_generator.build_prompt(completed_text),
+        )
+        # Different madlibs with the same text make the same image
+        image_data = await self.flights["image_prompt"].do(
+            prompt_key, lambda: self._image_data_for(prompt_key, completed_text)
+        )
+
+        # Each madlib gets its own file, so concurrent generations never collide
+        image_filename = f"{madlib_id}.png"
+        optimize = self.config.image_optimize.enabled
+        name = _unoptimized_name(image_filename) if optimize else image_filename
+        with self.metrics.time_stage("image_write"):
+            await self.image_store.write(name, image_data)
+        if self.hot_images is not None:
+            # It is about to be fetched by whoever asked for it
+            self.hot_images.put(
+                name,
+                await asyncio.to_thread(
+                    ServedImage.from_bytes, image_data, "image/png"
+                ),
+            )
+        if optimize:
+            self._optimize_image_later(image_filename, image_data, prompt_key)
+        return self._image_result(madlib_id)
+
+    def _optimize_image_later(
+        self, image_filename: str, image_data: bytes, cache_key: str
+    ):
+        """Shrink a stored image in the background, off the request path"""
+        task = asyncio.create_task(
+            self._store_optimized_image(image_filename, image_data, cache_key)
+        )
+        self._optimizations.add(task)
+        task.add_done_callback(self._optimizations.discard)
+
+    async def _store_optimized_image(
+        self, image_filename: str, image_data: bytes, cache_key: str
+    ):
         """
-        Serve generated images
+        Publish the optimized image under its URL's own name, which makes it
+        cacheable for good, and drop the unoptimized copy served until now
         """
-        image_path = self.image_dir / image_filename
-        if not image_path.exists():
+        optimized = await self._optimize_image(image_data)
+        unoptimized = _unoptimized_name(image_filename)
+        try:
+            await self.image_store.write(image_filename, optimized)
+            if self.hot_images is not None:
+                self.hot_images.put(
+                    image_filename,
+                    await asyncio.to_thread(
+                        ServedImage.from_bytes, optimized, "image/png"
+                    ),
+                )
+                self.hot_images.discard(unoptimized)
+            await self.image_store.delete(unoptimized)
+            # Later madlibs with the same prompt start from the small copy
+            if self.image_cache is not None and optimized != image_data:
+                await asyncio.to_thread(self.image_cache.put, cache_key, optimized)
+        except Exception as e:
+            logger.error(f"Error storing optimized image {image_filename}: {str(e)}")
+
+    async def _optimize_image(self, image_data: bytes) -> bytes:
+        """Shrink an image, or return it as is if optimizing fails"""
+        optimize_config = self.config.image_optimize
+        try:
+            optimized, result = await self.image_processor.run(
+                optimize_png,
+                image_data,
+                optimize_config.max_colors,
+                optimize_config.min_psnr,
+            )
+        except Exception as e:
+            logger.error(f"Error optimizing image: {str(e)}")
+            self.optimization_stats["failed"] += 1
+            self.metrics.observe_image_optimization("failed")
+            return image_data
+
+        self.optimization_stats[result] += 1
+        self.optimization_stats["bytes_before"] += len(image_data)
+        self.optimization_stats["bytes_after"] += len(optimized)
+        self.metrics.observe_image_optimization(result, len(image_data), len(optimized))
+        logger.info(
+            f"Optimized image ({result}): {len(image_data)} -> {len(optimized)} bytes"
+        )
+        return optimized
+
+    async def _image_data_for(self, cache_key: str, completed_text: str) -> bytes:
+        if self.image_cache is not None:
+            image_data = await asyncio.to_thread(self.image_cache.get, cache_key)
+            if image_data is not None:
+                logger.info("Using cached image")
+                return image_data
+
+        # Generate image
+        logger.info("Generating image...")
+        image = await self._call_provider(
+            "image",
+            self.image_generator.generate,
+            self.image_generator.agenerate,
+            completed_text,
+        )
+        image_data = await asyncio.to_thread(image.to_png)
+        if self.image_cache is not None:
+            await asyncio.to_thread(self.image_cache.put, cache_key, image_data)
+        return image_data
+
+    def _image_result(self, madlib_id: str) -> dict:
+        return {
+            "madlib_id": madlib_id,
+            "image_url": f"/api/images/{madlib_id}.png",
+            "status": "success",
+        }
+
+    def _start_speculative_image(self, madlib_id: str, completed_text: str):
+        """
+        Start on the image as soon as the completed text exists, so it runs
+        alongside the comic prompt instead of after the next request
+        """
+        if not self.config.speculative_images:
+            return
+        task = self.flights["image"].start(
+            madlib_id, lambda: self._image_for(madlib_id, completed_text)
+        )
+        if task is None:
+            return
+        self._speculative_images.add(madlib_id)
+        self.speculative_stats["started"] += 1
+
+        def finished(task: asyncio.Task):
+            self._speculative_images.discard(madlib_id)
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                # A later generate-image call will simply try again
+                self.speculative_stats["failed"] += 1
+                logger.error(
+                    f"Speculative image generation failed: {str(task.exception())}"
+                )
+
+        task.add_done_callback(finished)
+
+    def _cancel_speculative_image(self, madlib_id: str):
+        if madlib_id in self._speculative_images and self.flights["image"].cancel(
+            madlib_id
+        ):
+            self.speculative_stats["cancelled"] += 1
+
+    async def _idempotent(
+        self, scope: str, key: Optional[str], request: BaseModel, handler
+    ):
+        """
+        Run a POST handler, or replay its earlier response when the client
+        repeats the same Idempotency-Key within the configured window
+        """
+        if key is None or self.idempotency is None:
+            return await handler()
+        fingerprint = hashlib.sha256(request.model_dump_json().encode()).hexdigest()
+        try:
+            stored, replayed = await self.idempotency.run(
+                scope, key, fingerprint, handler
+            )
+        except IdempotencyKeyReusedException as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        headers = dict(stored.headers)
+        if replayed:
+            logger.info(f"Replaying response for Idempotency-Key {key}")
+            headers["Idempotency-Replayed"] = "true"
+        return JSONResponse(
+            status_code=stored.status_code, content=stored.content, headers=headers
+        )
+
+    async def get_job(self, job_id: str, wait: float = 0):
+        """
+        Report the status of an image job. Pass ?wait=<seconds> to long-poll
+        until the job finishes or the wait runs out
+        """
+        wait = min(max(wait, 0), self.config.image_jobs.max_wait_seconds)
+        job = await self.image_jobs.status(job_id, wait=wait)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job
+
+    async def get_image(
+        self,
+        image_filename: str,
+        w: Optional[int] = Query(None, gt=0),
+        image_format: Optional[Literal["png", "webp"]] = Query(None, alias="format"),
+        if_none_match: Optional[str] = Header(None),
+        range_header: Optional[str] = Header(None, alias="Range"),
+        if_range: Optional[str] = Header(None),
+    ):
+        """
+        Serve generated images. They never change once written, so they carry
+        a content-hash ETag and may be cached forever; conditional and range
+        requests are answered without resending the whole image. The one
+        exception is a new image still waiting for its background
+        optimization, which is only cacheable briefly. ?w= and ?format= ask
+        for a smaller or WebP copy, made on first request and stored next to
+        the original
+        """
+        cache_control = self.image_cache_control
+        try:
+            name, width, variant_format = self._variant_for(
+                image_filename, w, image_format
+            )
+            if name == image_filename:
+                image, optimized = await self._original_image(name)
+                if not optimized:
+                    cache_control = self.unoptimized_image_cache_control
+            else:
+                image = await self._served_image(name)
+            if image is None and name != image_filename:
+                image = await self.flights["image_variant"].do(
+                    name,
+                    lambda: self._make_variant(
+                        image_filename, name, width, variant_format
+                    ),
+                )
+        except InvalidImageNameException:
             raise HTTPException(status_code=404, detail="Image not found")
+        if image is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+        return image_response(
+            image,
+            cache_control,
+            if_none_match=if_none_match,
+            range_header=range_header,
+            if_range=if_range,
+        )
 
-        return FileResponse(str(image_path), media_type="image/png")
+    async def _original_image(
+        self, image_filename: str
+    ) -> Tuple[Optional[ServedImage], bool]:
+        """
+        An image under its own name, or its unoptimized copy while the
+        optimized one is still being made, and which of the two it is
+        """
+        image = await self._served_image(image_filename)
+        if image is not None or not self.config.image_optimize.enabled:
+            return image, True
+        image = await self._served_image(_unoptimized_name(image_filename))
+        if image is None:
+            # The optimized copy may have just replaced it
+            return await self._served_image(image_filename), True
+        return image, False
+
+    async def _served_image(self, image_filename: str) -> Optional[ServedImage]:
+        if self.hot_images is not None:
+            image = self.hot_images.get(image_filename)
+            if image is not None:
+                return image
+        data = await self.image_store.read(image_filename)
+        if data is None:
+            return None
+        media_type = MEDIA_TYPES.get(image_filename.rpartition(".")[2], "image/png")
+        image = await asyncio.to_thread(ServedImage.from_bytes, data, media_type)
+        if self.hot_images is not None:
+            self.hot_images.put(image_filename, image)
+        return image
+
+    def _variant_for(
+        self, image_filename: str, width: Optional[int], image_format: Optional[str]
+    ) -> Tuple[str, Optional[int], str]:
+        """
+        Store name, width and format of the variant of an image a request asks
+        for; the image's own name when it asks for nothing different
+        """
+        ImageStore.check_name(image_filename)
+        stem, _, extension = image_filename.rpartition(".")
+        if extension not in MEDIA_TYPES:
+            stem, extension = image_filename, "png"
+        image_format = image_format or extension
+        if width is not None:
+            widths = sorted(self.config.image_serving.variant_widths)
+            width = next((w for w in widths if w >= width), widths[-1])
+            return f"{stem}.w{width}.{image_format}", width, image_format
+        if image_format == extension:
+            return image_filename, None, image_format
+        return f"{stem}.{image_format}", None, image_format
+
+    async def _make_variant(
+        self,
+        image_filename: str,
+        name: str,
+        width: Optional[int],
+        image_format: str,
+    ) -> Optional[ServedImage]:
+        original, _ = await self._original_image(image_filename)
+        if original is None:
+            return None
+        with self.metrics.time_stage("image_variant"):
+            data = await self.image_processor.run(
+                make_variant,
+                original.data,
+                width,
+                image_format,
+                self.config.image_serving.webp_quality,
+            )
+        await self.image_store.write(name, data)
+        image = await asyncio.to_thread(
+            ServedImage.from_bytes, data, MEDIA_TYPES[image_format]
+        )
+        if self.hot_images is not None:
+            self.hot_images.put(name, image)
+        return image
 
     # Health check endpoint
     async def health_check(self):
         """Check if the API is healthy and configured properly"""
+        templates_stats = await self.templates_store.stats()
+        madlibs_stats = await self.madlibs_store.stats()
         return {
             "status": "healthy",
             "api_key_configured": bool(self.api_key),
-            "templates_count": len(self.templates_store),
-            "madlibs_count": len(self.madlibs_store),
+            "templates_count": templates_stats["size"],
+            "madlibs_count": madlibs_stats["size"],
+            "stores": {"templates": templates_stats, "madlibs": madlibs_stats},
+            "async_providers": self.provider_http is not None,
+            "stages": {name: stage.stats() for name, stage in self.stages.items()},
+            "image_jobs": self.image_jobs.stats(),
+            "resilience": {
+                name: policy.stats() for name, policy in self.resilience.items()
+            },
+            "admission": {
+                group: controller.stats()
+                for group, controller in self.admission.items()
+            },
+            "idempotency": (
+                self.idempotency.stats() if self.idempotency is not None else None
+            ),
+            "singleflight": {
+                name: flight.stats() for name, flight in self.flights.items()
+            },
+            "speculative_images": {
+                "enabled": self.config.speculative_images,
+                "in_flight": len(self._speculative_images),
+                **self.speculative_stats,
+            },
+            "template_cache": (
+                self.template_cache.stats() if self.template_cache is not None else None
+            ),
+            "comic_cache": (
+                await self.comic_cache.stats() if self.comic_cache is not None else None
+            ),
+            "image_cache": (
+                await asyncio.to_thread(self.image_cache.stats)
+                if self.image_cache is not None
+                else None
+            ),
+            "hot_images": (
+                self.hot_images.stats() if self.hot_images is not None else None
+            ),
+            "template_checks": self.template_check_stats,
+            "image_processor": self.image_processor.stats(),
+            "image_optimization": {
+                "enabled": self.config.image_optimize.enabled,
+                "pending": len(self._optimizations),
+                **self.optimization_stats,
+            },
         }
 
+    async def get_metrics(self):
+        """Prometheus metrics, with the point-in-time gauges refreshed first"""
+        for name, stage in self.stages.items():
+            stage_stats = stage.stats()
+            self.metrics.stage_in_flight.labels(name).set(stage_stats["running"])
+            self.metrics.stage_queued.labels(name).set(stage_stats["queued"])
+        for name, store in (
+            ("templates", self.templates_store),
+            ("madlibs", self.madlibs_store),
+            ("jobs", self.image_jobs.store),
+        ):
+            store_stats = await store.stats()
+            self.metrics.store_items.labels(name).set(store_stats["size"])
+            self.metrics.cache_hit_ratio.labels(f"{name}_store").set(
+                store_stats["hit_ratio"]
+            )
+        if self.template_cache is not None:
+            cache_stats = self.template_cache.stats()
+            self.metrics.set_cache(
+                "template", cache_stats["topics"], cache_stats["hit_ratio"]
+            )
+        if self.comic_cache is not None:
+            cache_stats = await self.comic_cache.stats()
+            self.metrics.set_cache(
+                "comic_prompt", cache_stats["size"], cache_stats["hit_ratio"]
+            )
+        if self.image_cache is not None:
+            cache_stats = await asyncio.to_thread(self.image_cache.stats)
+            self.metrics.set_cache(
+                "image", cache_stats["images"], cache_stats["hit_ratio"]
+            )
+        if self.hot_images is not None:
+            cache_stats = self.hot_images.stats()
+            self.metrics.set_cache(
+                "hot_images", cache_stats["size"], cache_stats["hit_ratio"]
+            )
+        if self.idempotency is not None:
+            cache_stats = self.idempotency.stats()
+            self.metrics.set_cache(
+                "idempotency", cache_stats["size"], cache_stats["hit_ratio"]
+            )
+        for group, controller in self.admission.items():
+            self.metrics.admission_in_flight.labels(group).set(controller.in_flight)
+            self.metrics.admission_queued.labels(group).set(controller.queued)
+        for name, policy in self.resilience.items():
+            self.metrics.breaker_open.labels(name).set(
+                0 if policy.breaker.state == "closed" else 1
+            )
+        job_stats = self.image_jobs.stats()
+        for state in ("queued", "running", "completed", "failed", "rejected"):
+            self.metrics.image_jobs.labels(state).set(job_stats[state])
+        return Response(
+            content=self.metrics.render(), media_type=self.metrics.content_type
+        )
+
     def run(self):
         import uvicorn
 
-        uvicorn.run(self.app, host="localhost", port=8000)
+        uvicorn.run(
+            self.app, host=self.config.server.host, port=self.config.server.port
+        )
+
+
+def create_app() -> FastAPI:
+    """
+    App factory for uvicorn, used when serving with several worker processes
+    """
+    config = MadLibsConfig.from_env()
+    return MadLibsAPI(api_key=os.environ["GOOGLE_API_KEY"], config=config).app
@@ -0,0 +1,133 @@
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+import re
+
+PLACEHOLDER_PATTERN = re.compile(r"\{([^}]+)\}")
+_DOUBLE_BRACES = re.compile(r"\{\{([^{}]+)\}\}")
+
+Inputs = Union[Mapping[str, str], Sequence[str]]
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    """
+    A template split once into the literal text around its placeholders
+    (segments) and the placeholder names in order (slots), so there is always
+    one more segment than slot. Filling interleaves the two with a single
+    join instead of rescanning and copying the whole template per word.
+    """
+
+    segments: Tuple[str, ...]
+    slots: Tuple[str, ...]
+
+    @classmethod
+    def compile(cls, template: str) -> "CompiledTemplate":
+        parts = PLACEHOLDER_PATTERN.split(template)
+        # split() alternates literal text and captured slot names
+        return cls(tuple(parts[0::2]), tuple(parts[1::2]))
+
+    def fill(self, inputs: Inputs) -> str:
+        """
+        Fill every slot from inputs: either a mapping from word type to word,
+        where a word type used more than once gets the same word each time,
+        or a list with one word per slot in template order. A slot without a
+        word keeps its placeholder
+        """
+        words = self._words(inputs)
+        parts = [None] * (2 * len(self.slots) + 1)
+        parts[0::2] = self.segments
+        parts[1::2] = words
+        return "".join(parts)
+
+    def fill_many(self, inputs: Iterable[Inputs]) -> List[str]:
+        """fill() for many sets of words against the same template"""
+        return [self.fill(words) for words in inputs]
+
+    def fill_in_order(
+        self, word_types: Sequence[str], user_inputs: Sequence[str]
+    ) -> str:
+        """
+        Fill from words paired with the word types they were asked for. Each
+        slot takes the next unused word given for its type, so neither the
+        order of word_types nor repeated types have to line up with the
+        template
+        """
+        queues: Dict[str, deque] = defaultdict(deque)
+        for word_type, word in zip(word_types, user_inputs):
+            queues[word_type].append(word)
+        return self.fill(
+            [
+                queues[slot].popleft() if queues[slot] else f"{{{slot}}}"
+                for slot in self.slots
+            ]
+        )
+
+    def _words(self, inputs: Inputs) -> List[str]:
+        if isinstance(inputs, Mapping):
+            return [inputs.get(slot, f"{{{slot}}}") for slot in self.slots]
+        words = list(inputs[: len(self.slots)])
+        words.extend(f"{{{slot}}}" for slot in self.slots[len(words) :])
+        return words
+
+    def to_dict(self) -> dict:
+        return {"segments": list(self.segments), "slots": list(self.slots)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CompiledTemplate":
+        return cls(tuple(data["segments"]), tuple(data["slots"]))
+
+
+@dataclass(frozen=True)
+class TemplateCheck:
+    template: str
+    word_types: List[str]
+    # None when the template couldn't be repaired
+    compiled: Optional[CompiledTemplate]
+    result: str  # "valid", "repaired" or "invalid"
+
+
+def normalize_word_type(word_type: str) -> str:
+    return " ".join(word_type.split()).lower()
+
+
+def check_template(template: str, word_types: Sequence[str]) -> TemplateCheck:
+    """
+    Validate an LM-written template and its word_types, repairing what can be
+    fixed without asking the LM again. The template's own placeholders are
+    the authority: their names are lower cased with spacing tidied up,
+    {{doubled}} braces are undone, and word_types is rebuilt from the
+    placeholders. Word types written in [square] or <angle> brackets instead
+    of braces are converted when the template has no braced ones. Templates
+    with no placeholders, empty ones or stray braces are invalid
+    """
+    repaired = PLACEHOLDER_PATTERN.sub(
+        lambda match: f"{{{normalize_word_type(match.group(1))}}}",
+        _DOUBLE_BRACES.sub(r"{\1}", template),
+    )
+    if PLACEHOLDER_PATTERN.search(repaired) is None:
+        repaired = _brace_word_types(repaired, word_types)
+    compiled = CompiledTemplate.compile(repaired)
+    if (
+        not compiled.slots
+        or any("{" in slot for slot in compiled.slots)
+        or any("{" in segment or "}" in segment for segment in compiled.segments)
+    ):
+        return TemplateCheck(template, list(word_types), None, "invalid")
+
+    slots = list(compiled.slots)
+    if repaired == template and list(word_types) == slots:
+        return TemplateCheck(template, slots, compiled, "valid")
+    return TemplateCheck(repaired, slots, compiled, "repaired")
+
+
+def _brace_word_types(template: str, word_types: Sequence[str]) -> str:
+    for word_type in dict.fromkeys(map(normalize_word_type, word_types)):
+        if not word_type:
+            continue
+        pattern = re.compile(
+            rf"\[\s*{re.escape(word_type)}\s*\]|<\s*{re.escape(word_type)}\s*>",
+            re.IGNORECASE,
+        )
+        template = pattern.sub(f"{{{word_type}}}", template)
+    return template
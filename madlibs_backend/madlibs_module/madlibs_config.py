@@ -0,0 +1,489 @@
+from dataclasses import dataclass, field
+from typing import List
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_str(name: str, default: str) -> str:
+    return os.environ.get(name) or default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_int_list(name: str, default: List[int]) -> List[int]:
+    value = os.environ.get(name)
+    if value in (None, ""):
+        return default
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+@dataclass
+class StageConfig:
+    # Number of worker threads for the stage. This is also the maximum number
+    # of provider calls the stage will have in flight at once.
+    max_workers: int = 4
+    # With the async provider clients no threads are needed and this caps the
+    # stage's in-flight calls instead
+    max_concurrency: int = 256
+    # Each provider call attempt is abandoned after this long
+    timeout_seconds: float = 60.0
+    # Failed or timed out calls are retried this many times, sleeping a
+    # random time up to backoff_base * 2**attempt (capped at backoff_max)
+    retries: int = 2
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    # After failure_threshold failures in a row the stage fails fast for
+    # reset_seconds before trying the provider again
+    failure_threshold: int = 5
+    reset_seconds: float = 30.0
+    # Fire a second identical call when the first is slower than the p95 of
+    # recent calls (but never sooner than hedge_min_delay) and take the
+    # first answer
+    hedge: bool = False
+    hedge_min_delay: float = 1.0
+
+
+@dataclass
+class ProviderConfig:
+    # Call the providers through their asyncio clients on the event loop
+    # instead of tying up a stage thread per call
+    async_clients: bool = False
+    # Connection pool of the async image client (LiteLLM pools the LM's
+    # connections itself); idle connections are kept alive for
+    # keepalive_expiry seconds so calls skip the TCP/TLS handshake
+    max_connections: int = 512
+    max_keepalive_connections: int = 128
+    keepalive_expiry: float = 60.0
+
+
+@dataclass
+class ImageJobsConfig:
+    # Workers pulling jobs off the queue; actual provider concurrency is
+    # still capped by the image stage executor
+    workers: int = 4
+    # Jobs waiting beyond this are rejected with a 503
+    max_queue: int = 256
+    # Upper bound on how long GET /api/jobs/{id}?wait= may hold a request
+    max_wait_seconds: float = 30.0
+    # Finished jobs stay pollable for this long, up to max_jobs in total
+    retention_seconds: float = 3600.0
+    max_jobs: int = 10000
+
+
+@dataclass
+class ServerConfig:
+    host: str = "localhost"
+    port: int = 8000
+    # More than one worker needs the redis or sqlite store so any worker can
+    # serve any step of the flow. sqlite then writes every record through as
+    # it is put, since another worker can't see one still in the buffer
+    workers: int = 1
+
+
+@dataclass
+class BatchConfig:
+    # Templates generated at once per batch request, unless the request asks
+    # for fewer (or more, up to max_concurrency)
+    concurrency: int = 8
+    max_concurrency: int = 32
+    max_topics: int = 1000
+    # Input sets filled against one template per bulk fill request
+    max_fills: int = 10000
+
+
+@dataclass
+class TemplateCacheConfig:
+    enabled: bool = True
+    # Distinct templates collected per topic before the cache starts serving
+    # them; lookups then pick one of these at random
+    variants: int = 3
+    max_topics: int = 2048
+    ttl_seconds: float = 86400.0
+    # Let topics with no entry of their own reuse a near-duplicate's entry
+    fuzzy: bool = True
+    similarity_threshold: float = 0.75
+
+
+@dataclass
+class ComicCacheConfig:
+    enabled: bool = True
+    # Any record store backend; "sqlite" or "redis" keep the cache across
+    # restarts, using the same sqlite_path / redis_url as the main store
+    backend: str = "memory"
+    max_items: int = 4096
+    ttl_seconds: float = 3600.0
+
+
+@dataclass
+class ImageCacheConfig:
+    enabled: bool = True
+    # Content-addressed image files plus their index; each node keeps its own
+    # unless the directory is shared
+    directory: str = "image_cache"
+    # Least recently used images are evicted past this many bytes
+    max_bytes: int = 512 * 1024 * 1024
+
+
+@dataclass
+class ImageServingConfig:
+    # Content under an image URL never changes, so browsers and CDNs may keep
+    # it this long without revalidating
+    max_age_seconds: int = 31536000
+    # Recently served images kept in memory with their ETags (0 disables)
+    hot_cache_bytes: int = 64 * 1024 * 1024
+    # A ?w= request is rounded up to the nearest of these, so there are only
+    # ever a few variants of each image to make and cache
+    variant_widths: List[int] = field(default_factory=lambda: [128, 256, 512, 1024])
+    webp_quality: int = 80
+    # Processes resizing and re-encoding variants
+    processing_workers: int = 2
+
+
+@dataclass
+class ImageOptimizeConfig:
+    # Re-encode every new image in the background, as an indexed-palette PNG
+    # when that is close enough to the original, otherwise just recompressed
+    enabled: bool = True
+    max_colors: int = 256
+    # Quantized images below this peak signal-to-noise ratio (dB) are judged
+    # too far from the original and only recompressed losslessly
+    min_psnr: float = 40.0
+    # Until then the image is served as generated, cacheable only this long
+    # instead of for good, since the bytes behind its URL are about to change
+    unoptimized_max_age_seconds: int = 60
+
+
+@dataclass
+class IdempotencyConfig:
+    enabled: bool = True
+    # How long a response is replayed for a repeated Idempotency-Key
+    window_seconds: float = 86400.0
+    # Least recently used keys are forgotten past this many
+    max_keys: int = 10000
+
+
+@dataclass
+class TracingConfig:
+    # "none" disables tracing, "file" appends spans as JSON lines to
+    # file_path, "otlp" sends them to an OTLP/HTTP collector at otlp_endpoint
+    # (or wherever the standard OTEL_EXPORTER_OTLP_* variables point)
+    exporter: str = "none"
+    file_path: str = "traces.jsonl"
+    otlp_endpoint: str = ""
+    service_name: str = "madlibs-api"
+
+
+@dataclass
+class AdmissionLimits:
+    # Requests handled at once; more than this wait in a queue
+    max_in_flight: int
+    # Requests allowed to wait; beyond this new ones are rejected with a 503
+    max_queued: int
+    # Seconds a request may wait for a slot before it is rejected
+    max_queue_wait: float
+
+
+@dataclass
+class AdmissionConfig:
+    enabled: bool = True
+    # Sent as Retry-After on rejected requests
+    retry_after_seconds: int = 5
+    template: AdmissionLimits = field(
+        default_factory=lambda: AdmissionLimits(32, 64, 10.0)
+    )
+    batch: AdmissionLimits = field(default_factory=lambda: AdmissionLimits(2, 4, 5.0))
+    submit: AdmissionLimits = field(
+        default_factory=lambda: AdmissionLimits(32, 64, 10.0)
+    )
+    image: AdmissionLimits = field(default_factory=lambda: AdmissionLimits(8, 16, 20.0))
+    complete: AdmissionLimits = field(
+        default_factory=lambda: AdmissionLimits(8, 16, 20.0)
+    )
+
+
+@dataclass
+class StoreConfig:
+    # "memory" keeps records in a bounded per-process LRU, "sqlite" persists
+    # them to sqlite_path and "redis" shares them through redis_url
+    backend: str = "memory"
+    # Least recently used records are evicted past this many per store
+    max_items: int = 10000
+    # Records older than this are treated as gone (0 keeps them forever)
+    ttl_seconds: float = 86400.0
+    sqlite_path: str = "madlibs.db"
+    # SQLite writes are buffered and committed together once batch_size are
+    # pending or every flush_interval seconds, whichever comes first
+    batch_size: int = 32
+    flush_interval: float = 0.5
+    redis_url: str = "redis://localhost:6379/0"
+
+
+@dataclass
+class ImageStoreConfig:
+    # "local" writes files to directory (share it between nodes with a network
+    # mount), "redis" keeps image blobs on the server at redis_url
+    backend: str = "local"
+    directory: str = "generated_images"
+    redis_url: str = "redis://localhost:6379/0"
+    # Only used by the redis backend (0 keeps images forever)
+    ttl_seconds: float = 0
+
+
+@dataclass
+class MadLibsConfig:
+    server: ServerConfig = field(default_factory=ServerConfig)
+    template_stage: StageConfig = field(default_factory=lambda: StageConfig(8))
+    comic_stage: StageConfig = field(default_factory=lambda: StageConfig(8))
+    image_stage: StageConfig = field(
+        default_factory=lambda: StageConfig(4, timeout_seconds=120.0)
+    )
+    providers: ProviderConfig = field(default_factory=ProviderConfig)
+    image_jobs: ImageJobsConfig = field(default_factory=ImageJobsConfig)
+    # Start generating the image as soon as a madlib is submitted, alongside
+    # the comic prompt, so a later generate-image call finds it ready
+    speculative_images: bool = False
+    # Cancel a request's provider calls when its client disconnects, unless
+    # another request is waiting on the same call
+    cancel_on_disconnect: bool = True
+    # Generated templates that can't be repaired locally (no placeholders,
+    # stray braces) are generated again, at most this many times
+    template_regenerations: int = 2
+    batch: BatchConfig = field(default_factory=BatchConfig)
+    template_cache: TemplateCacheConfig = field(default_factory=TemplateCacheConfig)
+    comic_cache: ComicCacheConfig = field(default_factory=ComicCacheConfig)
+    image_cache: ImageCacheConfig = field(default_factory=ImageCacheConfig)
+    image_serving: ImageServingConfig = field(default_factory=ImageServingConfig)
+    image_optimize: ImageOptimizeConfig = field(default_factory=ImageOptimizeConfig)
+    idempotency: IdempotencyConfig = field(default_factory=IdempotencyConfig)
+    tracing: TracingConfig = field(default_factory=TracingConfig)
+    admission: AdmissionConfig = field(default_factory=AdmissionConfig)
+    store: StoreConfig = field(default_factory=StoreConfig)
+    images: ImageStoreConfig = field(default_factory=ImageStoreConfig)
+
+    @classmethod
+    def from_env(cls) -> "MadLibsConfig":
+        """Build a config from MADLIBS_* environment variables, falling back to the defaults"""
+        config = cls()
+        config.server.host = _env_str("MADLIBS_HOST", config.server.host)
+        config.server.port = _env_int("MADLIBS_PORT", config.server.port)
+        config.server.workers = _env_int("MADLIBS_WORKERS", config.server.workers)
+        config.template_stage.max_workers = _env_int(
+            "MADLIBS_TEMPLATE_WORKERS", config.template_stage.max_workers
+        )
+        config.comic_stage.max_workers = _env_int(
+            "MADLIBS_COMIC_WORKERS", config.comic_stage.max_workers
+        )
+        config.image_stage.max_workers = _env_int(
+            "MADLIBS_IMAGE_WORKERS", config.image_stage.max_workers
+        )
+        for prefix, stage in (
+            ("MADLIBS_TEMPLATE", config.template_stage),
+            ("MADLIBS_COMIC", config.comic_stage),
+            ("MADLIBS_IMAGE", config.image_stage),
+        ):
+            stage.timeout_seconds = _env_float(
+                f"{prefix}_TIMEOUT", stage.timeout_seconds
+            )
+            stage.max_concurrency = _env_int(
+                f"{prefix}_CONCURRENCY", stage.max_concurrency
+            )
+            stage.retries = _env_int(f"{prefix}_RETRIES", stage.retries)
+            stage.hedge = _env_bool(f"{prefix}_HEDGE", stage.hedge)
+            stage.failure_threshold = _env_int(
+                "MADLIBS_BREAKER_THRESHOLD", stage.failure_threshold
+            )
+            stage.reset_seconds = _env_float(
+                "MADLIBS_BREAKER_RESET", stage.reset_seconds
+            )
+        config.providers.async_clients = _env_bool(
+            "MADLIBS_ASYNC_PROVIDERS", config.providers.async_clients
+        )
+        config.providers.max_connections = _env_int(
+            "MADLIBS_PROVIDER_MAX_CONNECTIONS", config.providers.max_connections
+        )
+        config.providers.max_keepalive_connections = _env_int(
+            "MADLIBS_PROVIDER_KEEPALIVE_CONNECTIONS",
+            config.providers.max_keepalive_connections,
+        )
+        config.providers.keepalive_expiry = _env_float(
+            "MADLIBS_PROVIDER_KEEPALIVE_EXPIRY", config.providers.keepalive_expiry
+        )
+        config.image_jobs.workers = _env_int(
+            "MADLIBS_IMAGE_JOB_WORKERS", config.image_jobs.workers
+        )
+        config.image_jobs.max_queue = _env_int(
+            "MADLIBS_IMAGE_JOB_QUEUE", config.image_jobs.max_queue
+        )
+        config.image_jobs.max_wait_seconds = _env_float(
+            "MADLIBS_JOB_MAX_WAIT", config.image_jobs.max_wait_seconds
+        )
+        config.image_jobs.retention_seconds = _env_float(
+            "MADLIBS_JOB_RETENTION", config.image_jobs.retention_seconds
+        )
+        config.speculative_images = _env_bool(
+            "MADLIBS_SPECULATIVE_IMAGES", config.speculative_images
+        )
+        config.cancel_on_disconnect = _env_bool(
+            "MADLIBS_CANCEL_ON_DISCONNECT", config.cancel_on_disconnect
+        )
+        config.template_regenerations = _env_int(
+            "MADLIBS_TEMPLATE_REGENERATIONS", config.template_regenerations
+        )
+        config.batch.concurrency = _env_int(
+            "MADLIBS_BATCH_CONCURRENCY", config.batch.concurrency
+        )
+        config.batch.max_concurrency = _env_int(
+            "MADLIBS_BATCH_MAX_CONCURRENCY", config.batch.max_concurrency
+        )
+        config.batch.max_topics = _env_int(
+            "MADLIBS_BATCH_MAX_TOPICS", config.batch.max_topics
+        )
+        config.batch.max_fills = _env_int(
+            "MADLIBS_BATCH_MAX_FILLS", config.batch.max_fills
+        )
+        config.template_cache.enabled = _env_bool(
+            "MADLIBS_TEMPLATE_CACHE", config.template_cache.enabled
+        )
+        config.template_cache.variants = _env_int(
+            "MADLIBS_TEMPLATE_CACHE_VARIANTS", config.template_cache.variants
+        )
+        config.template_cache.max_topics = _env_int(
+            "MADLIBS_TEMPLATE_CACHE_MAX_TOPICS", config.template_cache.max_topics
+        )
+        config.template_cache.ttl_seconds = _env_float(
+            "MADLIBS_TEMPLATE_CACHE_TTL", config.template_cache.ttl_seconds
+        )
+        config.template_cache.fuzzy = _env_bool(
+            "MADLIBS_TEMPLATE_CACHE_FUZZY", config.template_cache.fuzzy
+        )
+        config.template_cache.similarity_threshold = _env_float(
+            "MADLIBS_TEMPLATE_CACHE_SIMILARITY",
+            config.template_cache.similarity_threshold,
+        )
+        config.comic_cache.enabled = _env_bool(
+            "MADLIBS_COMIC_CACHE", config.comic_cache.enabled
+        )
+        config.comic_cache.backend = _env_str(
+            "MADLIBS_COMIC_CACHE_BACKEND", config.comic_cache.backend
+        )
+        config.comic_cache.max_items = _env_int(
+            "MADLIBS_COMIC_CACHE_MAX_ITEMS", config.comic_cache.max_items
+        )
+        config.comic_cache.ttl_seconds = _env_float(
+            "MADLIBS_COMIC_CACHE_TTL", config.comic_cache.ttl_seconds
+        )
+        config.image_cache.enabled = _env_bool(
+            "MADLIBS_IMAGE_CACHE", config.image_cache.enabled
+        )
+        config.image_cache.directory = _env_str(
+            "MADLIBS_IMAGE_CACHE_DIR", config.image_cache.directory
+        )
+        config.image_cache.max_bytes = (
+            _env_int(
+                "MADLIBS_IMAGE_CACHE_MAX_MB",
+                config.image_cache.max_bytes // (1024 * 1024),
+            )
+            * 1024
+            * 1024
+        )
+        config.image_serving.max_age_seconds = _env_int(
+            "MADLIBS_IMAGE_MAX_AGE", config.image_serving.max_age_seconds
+        )
+        config.image_serving.hot_cache_bytes = (
+            _env_int(
+                "MADLIBS_IMAGE_HOT_CACHE_MB",
+                config.image_serving.hot_cache_bytes // (1024 * 1024),
+            )
+            * 1024
+            * 1024
+        )
+        config.image_serving.variant_widths = _env_int_list(
+            "MADLIBS_IMAGE_VARIANT_WIDTHS", config.image_serving.variant_widths
+        )
+        config.image_serving.webp_quality = _env_int(
+            "MADLIBS_IMAGE_WEBP_QUALITY", config.image_serving.webp_quality
+        )
+        config.image_serving.processing_workers = _env_int(
+            "MADLIBS_IMAGE_PROCESSING_WORKERS", config.image_serving.processing_workers
+        )
+        config.image_optimize.enabled = _env_bool(
+            "MADLIBS_IMAGE_OPTIMIZE", config.image_optimize.enabled
+        )
+        config.image_optimize.max_colors = _env_int(
+            "MADLIBS_IMAGE_PALETTE_COLORS", config.image_optimize.max_colors
+        )
+        config.image_optimize.min_psnr = _env_float(
+            "MADLIBS_IMAGE_MIN_PSNR", config.image_optimize.min_psnr
+        )
+        config.image_optimize.unoptimized_max_age_seconds = _env_int(
+            "MADLIBS_IMAGE_UNOPTIMIZED_MAX_AGE",
+            config.image_optimize.unoptimized_max_age_seconds,
+        )
+        config.idempotency.enabled = _env_bool(
+            "MADLIBS_IDEMPOTENCY", config.idempotency.enabled
+        )
+        config.idempotency.window_seconds = _env_float(
+            "MADLIBS_IDEMPOTENCY_WINDOW", config.idempotency.window_seconds
+        )
+        config.idempotency.max_keys = _env_int(
+            "MADLIBS_IDEMPOTENCY_MAX_KEYS", config.idempotency.max_keys
+        )
+        config.tracing.exporter = _env_str("MADLIBS_TRACING", config.tracing.exporter)
+        config.tracing.file_path = _env_str(
+            "MADLIBS_TRACE_FILE", config.tracing.file_path
+        )
+        config.tracing.otlp_endpoint = _env_str(
+            "MADLIBS_OTLP_ENDPOINT", config.tracing.otlp_endpoint
+        )
+        config.admission.enabled = _env_bool(
+            "MADLIBS_ADMISSION", config.admission.enabled
+        )
+        config.admission.retry_after_seconds = _env_int(
+            "MADLIBS_ADMISSION_RETRY_AFTER", config.admission.retry_after_seconds
+        )
+        for group in ("template", "batch", "submit", "image", "complete"):
+            limits = getattr(config.admission, group)
+            prefix = f"MADLIBS_ADMISSION_{group.upper()}"
+            limits.max_in_flight = _env_int(f"{prefix}_IN_FLIGHT", limits.max_in_flight)
+            limits.max_queued = _env_int(f"{prefix}_QUEUED", limits.max_queued)
+            limits.max_queue_wait = _env_float(f"{prefix}_WAIT", limits.max_queue_wait)
+        config.store.backend = _env_str("MADLIBS_STORE_BACKEND", config.store.backend)
+        config.store.max_items = _env_int(
+            "MADLIBS_STORE_MAX_ITEMS", config.store.max_items
+        )
+        config.store.ttl_seconds = _env_float(
+            "MADLIBS_STORE_TTL", config.store.ttl_seconds
+        )
+        config.store.sqlite_path = _env_str(
+            "MADLIBS_SQLITE_PATH", config.store.sqlite_path
+        )
+        config.store.batch_size = _env_int(
+            "MADLIBS_SQLITE_BATCH_SIZE", config.store.batch_size
+        )
+        config.store.flush_interval = _env_float(
+            "MADLIBS_SQLITE_FLUSH_INTERVAL", config.store.flush_interval
+        )
+        if config.server.workers > 1 and config.store.backend == "sqlite":
+            config.store.batch_size = 1
+        config.store.redis_url = _env_str("MADLIBS_REDIS_URL", config.store.redis_url)
+        config.images.backend = _env_str("MADLIBS_IMAGE_STORE", config.images.backend)
+        config.images.directory = _env_str("MADLIBS_IMAGE_DIR", config.images.directory)
+        config.images.redis_url = config.store.redis_url
+        config.images.ttl_seconds = _env_float(
+            "MADLIBS_IMAGE_TTL", config.images.ttl_seconds
+        )
+        return config
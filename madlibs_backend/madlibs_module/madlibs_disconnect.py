@@ -0,0 +1,82 @@
+from typing import Callable, Optional, Set, Tuple
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DisconnectMiddleware:
+    """
+    ASGI middleware that cancels the handling of a request on the given
+    (method, path) routes as soon as its client disconnects, so a closed tab
+    stops paying for provider calls. Work shared with other requests is
+    coalesced and shielded, so it only stops once nobody is waiting on it.
+    Cancelled requests are marked in the scope so outer middleware can
+    report them as 499 (client closed request). on_cancel, if given, is
+    called with the path of every request cancelled this way.
+    """
+
+    def __init__(
+        self,
+        app,
+        routes: Set[Tuple[str, str]],
+        on_cancel: Optional[Callable[[str], None]] = None,
+    ):
+        self.app = app
+        self.routes = routes
+        self.on_cancel = on_cancel
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or (scope["method"], scope["path"]) not in self.routes
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        body_read = asyncio.Event()
+        disconnected = asyncio.Event()
+
+        async def app_receive():
+            # Once the body is in, only the watcher reads from the client; the
+            # app (a streaming response, say) just hears about the disconnect
+            if body_read.is_set():
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+            elif not message.get("more_body", False):
+                body_read.set()
+            return message
+
+        async def watch():
+            await body_read.wait()
+            try:
+                while (await receive())["type"] != "http.disconnect":
+                    pass
+            except Exception as e:
+                # Can't tell any more, so let the request run to the end
+                logger.warning(f"Stopped watching for disconnects: {str(e)}")
+                return
+            disconnected.set()
+
+        handler = asyncio.create_task(self.app(scope, app_receive, send))
+        watcher = asyncio.create_task(watch())
+        try:
+            await asyncio.wait({handler, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not handler.done() and disconnected.is_set():
+                logger.info(f"Client disconnected, cancelling {scope['path']}")
+                handler.cancel()
+                scope["madlibs.client_disconnected"] = True
+                if self.on_cancel is not None:
+                    self.on_cancel(scope["path"])
+            try:
+                await handler
+            except asyncio.CancelledError:
+                if not scope.get("madlibs.client_disconnected"):
+                    raise
+        finally:
+            watcher.cancel()
+            if not handler.done():
+                handler.cancel()
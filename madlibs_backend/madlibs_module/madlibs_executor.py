@@ -0,0 +1,188 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StageExecutor:
+    """
+    Runs the blocking provider calls of one pipeline stage on a dedicated,
+    bounded thread pool so the event loop never waits on them. Async provider
+    calls go through run_async instead, which needs no thread and only caps
+    them at max_concurrency. The optional observer is called after every
+    call with (stage, run_seconds=, failed=, wait_seconds=). A call's
+    on_start, if given, is called on the loop once a worker picks it up, so
+    callers can time the provider call without the wait in the queue.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_workers: int,
+        observer: Optional[Callable[..., None]] = None,
+        max_concurrency: int = 256,
+    ):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency
+        self.observer = observer
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"madlibs-{name}"
+        )
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._started = 0
+        self._completed = 0
+        self._failed = 0
+        self._total_wait = 0.0
+        self._total_run = 0.0
+
+    async def run(
+        self, fn, *args, on_start: Optional[Callable[[], None]] = None, **kwargs
+    ):
+        if on_start is not None:
+            loop = asyncio.get_running_loop()
+            notify = functools.partial(loop.call_soon_threadsafe, on_start)
+        else:
+            notify = None
+        # Like asyncio.to_thread, carry the caller's context into the worker
+        ctx = contextvars.copy_context()
+        call = functools.partial(
+            ctx.run, self._call, fn, time.perf_counter(), notify, *args, **kwargs
+        )
+        with self._lock:
+            self._queued += 1
+        future = self._pool.submit(call)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Cancelling before a worker picked the call up means it never runs
+            if future.cancelled():
+                with self._lock:
+                    self._queued -= 1
+            raise
+
+    async def run_async(
+        self, fn, *args, on_start: Optional[Callable[[], None]] = None, **kwargs
+    ):
+        """Await an async provider call on the loop, once a slot is free"""
+        submitted_at = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+        try:
+            await self._slots.acquire()
+        except asyncio.CancelledError:
+            with self._lock:
+                self._queued -= 1
+            raise
+        try:
+            started_at = self._begin(submitted_at)
+            if on_start is not None:
+                on_start()
+            failed = True
+            try:
+                result = await fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self._finish(submitted_at, started_at, failed)
+        finally:
+            self._slots.release()
+
+    @asynccontextmanager
+    async def slot(self, blocking: bool, on_start: Optional[Callable[[], None]] = None):
+        """
+        Hold one unit of the stage's capacity while the enclosed block runs
+        provider work the executor can't run itself, such as a streamed LM
+        call that DSPy drives. With blocking calls that unit is one of the
+        pool's threads, parked until the block exits, otherwise one of the
+        max_concurrency slots. The hold queues and is counted like any call
+        """
+        started = asyncio.Event()
+        if blocking:
+            release = threading.Event()
+            hold = self.run(release.wait, on_start=started.set)
+        else:
+            release = asyncio.Event()
+            hold = self.run_async(release.wait, on_start=started.set)
+        held = asyncio.ensure_future(hold)
+        try:
+            await started.wait()
+            if on_start is not None:
+                on_start()
+            yield
+        finally:
+            release.set()
+            if not started.is_set():
+                held.cancel()
+
+    def _call(self, fn, submitted_at, notify, *args, **kwargs):
+        started_at = self._begin(submitted_at)
+        if notify is not None:
+            notify()
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self._finish(submitted_at, started_at, failed)
+
+    def _begin(self, submitted_at: float) -> float:
+        started_at = time.perf_counter()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._started += 1
+            self._total_wait += started_at - submitted_at
+        return started_at
+
+    def _finish(self, submitted_at: float, started_at: float, failed: bool):
+        run = time.perf_counter() - started_at
+        with self._lock:
+            self._running -= 1
+            self._total_run += run
+            if failed:
+                self._failed += 1
+            else:
+                self._completed += 1
+        if self.observer is not None:
+            self.observer(
+                self.name,
+                run_seconds=run,
+                failed=failed,
+                wait_seconds=started_at - submitted_at,
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            finished = self._completed + self._failed
+            return {
+                "max_workers": self.max_workers,
+                "max_concurrency": self.max_concurrency,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "avg_wait_ms": (
+                    round(1000 * self._total_wait / self._started, 2)
+                    if self._started
+                    else 0.0
+                ),
+                "avg_run_ms": (
+                    round(1000 * self._total_run / finished, 2) if finished else 0.0
+                ),
+            }
+
+    def shutdown(self):
+        logger.info(f"Shutting down {self.name} stage executor")
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,7 +1,12 @@
 from .comic_prompt import ComicPromptModule
+from .madlibs_compiled_template import CompiledTemplate, check_template
 from .madlibs_template import MadLibsTemplateModule
+from .madlibs_tracing import DSPyTracingCallback
 import dspy
-import re
+from dspy.streaming import StreamListener
+import hashlib
+import json
+from typing import Optional
 from pprint import pprint
 import logging
 
@@ -13,7 +18,12 @@ class MadlibsMismatchException(Exception):
 
 
 class MadLibsGenerator:
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        timeout: Optional[float] = None,
+        async_calls: bool = False,
+    ):
         logging.info("Initializing MadLibsApp......")
         lm = dspy.LM(
             # Change the model name here to your specified to provider
@@ -23,29 +33,77 @@ class MadLibsGenerator:
             api_key=api_key,
             cache=False,
             temperature=1.0,
+            # Seconds before a request to the provider is given up on
+            timeout=timeout,
         )
-        dspy.configure(lm=lm, api_key=api_key)
+        # Every module and LM call opens a span when tracing is configured
+        dspy.configure(lm=lm, api_key=api_key, callbacks=[DSPyTracingCallback()])
+        self.lm = lm
+        # Call the modules through acall on the event loop. LiteLLM pools
+        # the connections of its async requests itself
+        self.async_calls = async_calls
         self.madlibs_generator = MadLibsTemplateModule()
         self.comicprompt_generator = ComicPromptModule()
         logging.info("MadLibsApp successfully initialized")
 
-    def generate_madlib(self, topic: str):
-        result = self.madlibs_generator(topic)
-        template, placeholder_words = result.template, result.word_types
-        pprint(template)
-        pattern = r"\{([^}]+)\}"
-        word_types_needed = re.findall(pattern, template)
-        if placeholder_words != word_types_needed:
-            logging.error("Mismatch detected between words extracted and words needed")
-            raise MadlibsMismatchException(
-                "Mismatch between words extracted and words needed"
-            )
-        user_inputs = self.collect_user_inputs(placeholder_words=placeholder_words)
-        completed_madlib = self.fill_template(
-            template=template,
-            placeholder_words=placeholder_words,
-            user_inputs=user_inputs,
+    def comic_prompt_cache_key(self, completed_madlibs: str) -> str:
+        """
+        Cache key for a comic prompt: the completed text plus everything about
+        the LM that could change the answer (but never the API key)
+        """
+        lm_config = {
+            "model": self.lm.model,
+            **{
+                k: v
+                for k, v in self.lm.kwargs.items()
+                if k not in ("api_key", "timeout")
+            },
+        }
+        payload = json.dumps(
+            [lm_config, completed_madlibs], sort_keys=True, default=str
         )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def stream_template(self, topic: str):
+        """
+        Async generator yielding StreamResponse chunks of the template text as
+        the LM produces them, then the final prediction
+        """
+        # Listeners keep per-call state, so every stream gets fresh ones
+        program = dspy.streamify(
+            self.madlibs_generator,
+            stream_listeners=[StreamListener(signature_field_name="template")],
+            is_async_program=self.async_calls,
+        )
+        return program(topic=topic)
+
+    def stream_comic_prompt(self, completed_madlibs: str):
+        """
+        Async generator yielding StreamResponse chunks of the comic prompt and
+        panel suggestions, then the final prediction
+        """
+        program = dspy.streamify(
+            self.comicprompt_generator,
+            stream_listeners=[
+                StreamListener(signature_field_name="comic_prompt"),
+                StreamListener(signature_field_name="panel_suggestions"),
+            ],
+            is_async_program=self.async_calls,
+        )
+        return program(completed_madlibs=completed_madlibs)
+
+    def generate_madlib(self, topic: str, regenerations: int = 2):
+        for _ in range(regenerations + 1):
+            result = self.madlibs_generator(topic)
+            checked = check_template(result.template, result.word_types)
+            if checked.compiled is not None:
+                break
+            logging.warning(f"Template could not be repaired: {result.template!r}")
+        else:
+            raise MadlibsMismatchException("Generated template could not be repaired")
+        pprint(checked.template)
+        user_inputs = self.collect_user_inputs(placeholder_words=checked.word_types)
+        completed_madlib = checked.compiled.fill(user_inputs)
         comic_prompt = self.comicprompt_generator(completed_madlib)
         return completed_madlib, comic_prompt
 
@@ -57,9 +115,5 @@ class MadLibsGenerator:
         return user_inputs
 
     def fill_template(self, template, placeholder_words, user_inputs):
-        completed = template
-
-        for word, user_input in zip(placeholder_words, user_inputs):
-            placeholder = f"{{{word}}}"
-            completed = completed.replace(placeholder, user_input, 1)
-        return completed
+        compiled = CompiledTemplate.compile(template)
+        return compiled.fill_in_order(placeholder_words, user_inputs)
@@ -0,0 +1,21 @@
+from typing import Optional
+import httpx
+from madlibs_module.madlibs_config import ProviderConfig
+
+
+def create_provider_http_client(
+    config: ProviderConfig, timeout: Optional[float] = None
+) -> httpx.AsyncClient:
+    """
+    The pooled HTTP client for the async image client, so concurrent calls
+    reuse kept-alive connections instead of each opening (and TLS
+    handshaking) its own
+    """
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+            keepalive_expiry=config.keepalive_expiry,
+        ),
+        timeout=timeout,
+    )
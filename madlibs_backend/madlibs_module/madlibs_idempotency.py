@@ -0,0 +1,112 @@
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Tuple
+import json
+import logging
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from madlibs_module.madlibs_cache import LRUCache
+from madlibs_module.madlibs_singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Headers that describe the stored body rather than the response itself
+_SKIPPED_HEADERS = ("content-length", "content-type")
+
+
+class IdempotencyKeyReusedException(Exception):
+    pass
+
+
+@dataclass
+class StoredResponse:
+    status_code: int
+    content: Any
+    headers: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_result(cls, result) -> "StoredResponse":
+        """Capture a handler's return value, whether a model, a dict or a JSONResponse"""
+        if isinstance(result, Response):
+            return cls(
+                status_code=result.status_code,
+                content=json.loads(result.body),
+                headers={
+                    name: value
+                    for name, value in result.headers.items()
+                    if name not in _SKIPPED_HEADERS
+                },
+            )
+        return cls(status_code=200, content=jsonable_encoder(result))
+
+
+class IdempotencyStore:
+    """
+    Remembers the response to each (route, Idempotency-Key) for a while, so a
+    client retrying a POST gets the original response back instead of a
+    second record and a second provider call. A retry that arrives while the
+    first attempt is still running waits for it and is answered as a replay; a
+    different request under that key is rejected. Only successful responses
+    are remembered; failures can be retried with the same key. Keys live in
+    a bounded in-process LRU, so they are not shared between workers.
+    """
+
+    def __init__(self, max_keys: int, window_seconds: float):
+        self._responses = LRUCache(max_items=max_keys, ttl_seconds=window_seconds)
+        self._flights = SingleFlight("idempotency")
+        # Fingerprint of the request running under each key
+        self._in_flight: Dict[Tuple[str, str], str] = {}
+        self.replays = 0
+        self.joins = 0
+
+    async def run(
+        self,
+        scope: str,
+        key: str,
+        fingerprint: str,
+        fn: Callable[[], Awaitable[Any]],
+    ) -> Tuple[StoredResponse, bool]:
+        """
+        The response for this key, running fn() only if there isn't one yet.
+        Returns the response and whether it was replayed rather than fresh
+        """
+        store_key = (scope, key)
+        stored = self._responses.get(store_key)
+        if stored is not None:
+            request_fingerprint, response = stored
+            if request_fingerprint != fingerprint:
+                raise IdempotencyKeyReusedException(
+                    "Idempotency-Key was already used with a different request"
+                )
+            self.replays += 1
+            return response, True
+
+        async def execute() -> StoredResponse:
+            response = StoredResponse.from_result(await fn())
+            if 200 <= response.status_code < 300:
+                self._responses.put(store_key, (fingerprint, response))
+            return response
+
+        flight_key = f"{scope}\n{key}"
+        if flight_key in self._flights:
+            if self._in_flight.get(store_key) != fingerprint:
+                raise IdempotencyKeyReusedException(
+                    "Idempotency-Key is already in use by a different request"
+                )
+            self.joins += 1
+            return await self._flights.do(flight_key, execute), True
+
+        # Started detached so the first attempt keeps going when its client
+        # drops, which is exactly when the retry is about to show up
+        task = self._flights.start(flight_key, execute)
+        self._in_flight[store_key] = fingerprint
+        task.add_done_callback(lambda _: self._in_flight.pop(store_key, None))
+        response = await self._flights.do(flight_key, execute)
+        return response, False
+
+    def stats(self) -> dict:
+        return {
+            **self._responses.stats(),
+            "replays": self.replays,
+            "joins": self.joins,
+            "in_flight": len(self._flights),
+        }
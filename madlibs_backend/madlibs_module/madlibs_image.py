@@ -2,19 +2,56 @@ from google import genai
 from google.genai import types
 from PIL import Image
 from io import BytesIO
-from pathlib import Path
+from dataclasses import dataclass
+from typing import Optional
+import httpx
+import logging
+from .madlibs_tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class NoImageGeneratedException(Exception):
+    pass
+
+
+@dataclass
+class GeneratedImage:
+    data: bytes
+    mime_type: str
+
+    def to_png(self) -> bytes:
+        # Gemini normally returns PNG already, so only re-encode when it doesn't
+        if self.mime_type == "image/png":
+            return self.data
+        buffer = BytesIO()
+        Image.open(BytesIO(self.data)).save(buffer, format="PNG")
+        return buffer.getvalue()
 
 
 class MadLibsImage:
     def __init__(
-        self, api_key: str, model: str = "gemini-2.0-flash-preview-image-generation"
+        self,
+        api_key: str,
+        model: str = "gemini-2.0-flash-preview-image-generation",
+        timeout: Optional[float] = None,
+        http_client: Optional[httpx.AsyncClient] = None,
     ):
-        self.client = genai.Client(api_key=api_key)
+        http_options = {}
+        if timeout:
+            # The SDK takes its timeout in milliseconds
+            http_options["timeout"] = int(timeout * 1000)
+        if http_client is not None:
+            # client.aio sends its requests over this pooled client
+            http_options["httpx_async_client"] = http_client
+        self.client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(**http_options) if http_options else None,
+        )
         self.model = model
 
-    def generate(
-        self, image_prompt: str, output_path: str = "madlibs_generated_image.png"
-    ) -> str:
+    def build_prompt(self, image_prompt: str) -> str:
+        """The full prompt sent to the model for a story"""
         base_style = """
         Create a simple, cartoon-style illustration in the classic MadLibs book art style with these characteristics:
         - Simple, clean line art with black outlines
@@ -38,21 +75,48 @@ class MadLibsImage:
         - Avoid photorealistic details
         - Focus on clarity and readability over artistic complexity
         """
-        response = self.client.models.generate_content(
-            model=self.model,
-            contents=f"{base_style}\n{story_prompt}\n{technical_instructions}",
-            config=types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"]),
-        )
+        return f"{base_style}\n{story_prompt}\n{technical_instructions}"
+
+    def generate(self, image_prompt: str) -> GeneratedImage:
+        """
+        Generate an illustration and return the raw image bytes from the
+        provider. Nothing is written to disk here; callers decide where it goes
+        """
+        with tracer.start_as_current_span(
+            "genai.generate_content", attributes={"gen_ai.request.model": self.model}
+        ) as span:
+            response = self.client.models.generate_content(
+                **self._request(image_prompt)
+            )
+            return self._image_from(response, span)
+
+    async def agenerate(self, image_prompt: str) -> GeneratedImage:
+        """generate, through the SDK's asyncio client"""
+        with tracer.start_as_current_span(
+            "genai.generate_content", attributes={"gen_ai.request.model": self.model}
+        ) as span:
+            response = await self.client.aio.models.generate_content(
+                **self._request(image_prompt)
+            )
+            return self._image_from(response, span)
+
+    def _request(self, image_prompt: str) -> dict:
+        return {
+            "model": self.model,
+            "contents": self.build_prompt(image_prompt),
+            "config": types.GenerateContentConfig(
+                response_modalities=["TEXT", "IMAGE"]
+            ),
+        }
 
-        saved = False
+    def _image_from(self, response, span) -> GeneratedImage:
         for part in response.candidates[0].content.parts:
             if part.text is not None:
-                print(part.text)
+                logger.info(part.text)
             elif part.inline_data is not None:
-                image = Image.open(BytesIO((part.inline_data.data)))
-                image.save(output_path)
-                saved = True
-        if saved:
-            return Path(output_path)
-        else:
-            raise Exception("No image generated")
+                span.set_attribute("madlibs.image.bytes", len(part.inline_data.data))
+                return GeneratedImage(
+                    data=part.inline_data.data,
+                    mime_type=part.inline_data.mime_type or "image/png",
+                )
+        raise NoImageGeneratedException("No image generated")
@@ -0,0 +1,127 @@
+from pathlib import Path
+from typing import Optional
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from madlibs_module.madlibs_tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache of generated images, keyed by a hash of
+    the model name and the full image prompt. A SQLite index next to the files
+    tracks sizes and last access so the cache survives restarts and can evict
+    least recently used images once it grows past max_bytes. Methods block,
+    so call them off the event loop.
+    """
+
+    _CREATE = (
+        "CREATE TABLE IF NOT EXISTS images ("
+        "key TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+    )
+    _INDEX = "CREATE INDEX IF NOT EXISTS images_lru ON images (accessed_at)"
+    _SELECT = "SELECT size FROM images WHERE key = ?"
+    _TOUCH = "UPDATE images SET accessed_at = ? WHERE key = ?"
+    _UPSERT = "INSERT OR REPLACE INTO images (key, size, accessed_at) VALUES (?, ?, ?)"
+    _DELETE = "DELETE FROM images WHERE key = ?"
+    _TOTALS = "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images"
+    _OLDEST = "SELECT key, size FROM images ORDER BY accessed_at LIMIT 64"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(self.directory / "index.db"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(self._CREATE)
+        self._conn.execute(self._INDEX)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\n{prompt}".encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.png"
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute(self._SELECT, (key,)).fetchone()
+            if row is not None:
+                try:
+                    data = self._path(key).read_bytes()
+                except FileNotFoundError:
+                    # The file went missing behind our back; forget about it
+                    self._conn.execute(self._DELETE, (key,))
+                    data = None
+                if data is not None:
+                    self._conn.execute(self._TOUCH, (time.time(), key))
+                    self.hits += 1
+                    return data
+            self.misses += 1
+            return None
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        with tracer.start_as_current_span(
+            "image_cache.write", attributes={"madlibs.image.bytes": len(data)}
+        ):
+            try:
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            with self._lock:
+                self._conn.execute(self._UPSERT, (key, len(data), time.time()))
+                self._evict()
+
+    def _evict(self):
+        # Totals come from the index rather than a counter so several
+        # processes can share one cache directory
+        _, total = self._conn.execute(self._TOTALS).fetchone()
+        while total > self.max_bytes:
+            oldest = self._conn.execute(self._OLDEST).fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                self._conn.execute(self._DELETE, (key,))
+                self._path(key).unlink(missing_ok=True)
+                self.evictions += 1
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total = self._conn.execute(self._TOTALS).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "images": count,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Optional, Tuple
+import asyncio
+import logging
+import math
+import multiprocessing
+from PIL import Image, ImageChops, ImageStat
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPES = {"png": "image/png", "webp": "image/webp"}
+
+
+def make_variant(data: bytes, width: Optional[int], fmt: str, quality: int) -> bytes:
+    """
+    Re-encode an image as fmt, scaled down to width (keeping its aspect
+    ratio) if it is wider than that. Runs in a worker process
+    """
+    image = Image.open(BytesIO(data))
+    image.load()
+    if width is not None and image.width > width:
+        height = max(round(image.height * width / image.width), 1)
+        image = image.resize((width, height), Image.LANCZOS)
+    buffer = BytesIO()
+    if fmt == "webp":
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def _psnr(original: Image.Image, approximation: Image.Image) -> float:
+    """Peak signal-to-noise ratio in dB; higher is closer, identical is inf"""
+    difference = ImageChops.difference(original, approximation.convert(original.mode))
+    mse = sum(rms**2 for rms in ImageStat.Stat(difference).rms) / len(
+        original.getbands()
+    )
+    return math.inf if mse == 0 else 10 * math.log10(255**2 / mse)
+
+
+def optimize_png(data: bytes, max_colors: int, min_psnr: float) -> Tuple[bytes, str]:
+    """
+    Shrink a PNG, returning the new bytes and what was done: "palette" when
+    it could be quantized to an adaptive palette of at most max_colors while
+    staying above min_psnr, "lossless" when only recompressing helped, and
+    "unchanged" (with the original bytes) when nothing did. The flat colors
+    the prompt asks for usually survive quantization with no visible loss.
+    Runs in a worker process
+    """
+    image = Image.open(BytesIO(data))
+    image.load()
+    if image.mode == "P":
+        # Already indexed, most likely by an earlier pass
+        return data, "unchanged"
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+    # Median cut picks better palettes but can't handle an alpha channel
+    method = (
+        Image.Quantize.MEDIANCUT if image.mode == "RGB" else Image.Quantize.FASTOCTREE
+    )
+    quantized = image.quantize(
+        colors=max_colors, method=method, dither=Image.Dither.NONE
+    )
+    if _psnr(image, quantized) >= min_psnr:
+        candidate, result = quantized, "palette"
+    else:
+        candidate, result = image, "lossless"
+    buffer = BytesIO()
+    candidate.save(buffer, format="PNG", optimize=True)
+    if buffer.tell() >= len(data):
+        return data, "unchanged"
+    return buffer.getvalue(), result
+
+
+def _warm_up():
+    pass
+
+
+class ImageProcessor:
+    """
+    A small process pool for CPU-heavy image work (resizing, re-encoding),
+    so it neither blocks the event loop nor competes for the GIL with the
+    request handlers. Spawned workers re-import the app's main module, so
+    start() gets that out of the way before the first request needs them.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.completed = 0
+        self.failed = 0
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Forking a process full of threads can deadlock the child
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def start(self):
+        for _ in range(self.max_workers):
+            self._executor().submit(_warm_up)
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        pool = self._executor()
+        try:
+            result = await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            # A worker died (out of memory, say); start over with a new pool
+            self.failed += 1
+            if self._pool is pool:
+                self._pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        self.completed += 1
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "started": self._pool is not None,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    def shutdown(self):
+        if self._pool is not None:
+            logger.info("Shutting down image processor")
+            self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,154 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+import hashlib
+import threading
+from fastapi.responses import Response
+
+
+@dataclass
+class ServedImage:
+    data: bytes
+    etag: str
+    media_type: str
+
+    @classmethod
+    def from_bytes(cls, data: bytes, media_type: str) -> "ServedImage":
+        # Strong validator: the same bytes always get the same tag, on any node
+        return cls(data, f'"{hashlib.sha256(data).hexdigest()[:32]}"', media_type)
+
+
+class HotImageCache:
+    """
+    The most recently served images, bytes and ETag together, so popular
+    images skip the store read and the hashing. Bounded by total bytes
+    rather than entries since images vary a lot in size.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, ServedImage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name: str) -> Optional[ServedImage]:
+        with self._lock:
+            image = self._data.get(name)
+            if image is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(name)
+            self.hits += 1
+            return image
+
+    def put(self, name: str, image: ServedImage):
+        if len(image.data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(name, None)
+            if old is not None:
+                self.bytes -= len(old.data)
+            self._data[name] = image
+            self.bytes += len(image.data)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.bytes -= len(evicted.data)
+                self.evictions += 1
+
+    def discard(self, name: str):
+        with self._lock:
+            old = self._data.pop(name, None)
+            if old is not None:
+                self.bytes -= len(old.data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in header.split(",")]
+    # If-None-Match compares weakly, so W/"x" matches "x"
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    The (start, end) inclusive byte range asked for by a single-range Range
+    header. None means serve the whole image (unsupported or several
+    ranges). A range that is empty or starts past the end can't be satisfied
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # bytes=-N is the last N bytes
+            suffix = int(last)
+            if suffix <= 0:
+                return (1, 0)
+            return (max(size - suffix, 0), size - 1)
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if end is None:
+        return (start, size - 1)
+    if start > end:
+        # Not a valid range at all, so it is ignored rather than refused
+        return None
+    return (start, min(end, size - 1))
+
+
+def image_response(
+    image: ServedImage,
+    cache_control: str,
+    if_none_match: Optional[str] = None,
+    range_header: Optional[str] = None,
+    if_range: Optional[str] = None,
+) -> Response:
+    """
+    Response for an image whose bytes never change under its URL: 304 when
+    the client already has it, 206 for a satisfiable byte range, 416 for an
+    unsatisfiable one, otherwise the whole image
+    """
+    headers = {
+        "ETag": image.etag,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if if_none_match and _etag_matches(if_none_match, image.etag):
+        return Response(status_code=304, headers=headers)
+
+    size = len(image.data)
+    # A Range is only honored if the client's copy is still the current one
+    if range_header and (not if_range or if_range.strip() == image.etag):
+        byte_range = _parse_range(range_header, size)
+        if byte_range is not None:
+            start, end = byte_range
+            if start > end or start >= size:
+                headers["Content-Range"] = f"bytes */{size}"
+                return Response(status_code=416, headers=headers)
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return Response(
+                content=image.data[start : end + 1],
+                status_code=206,
+                media_type=image.media_type,
+                headers=headers,
+            )
+    return Response(content=image.data, media_type=image.media_type, headers=headers)
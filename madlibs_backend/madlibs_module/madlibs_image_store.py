@@ -0,0 +1,138 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+import asyncio
+import os
+import re
+import uuid
+from madlibs_module.madlibs_config import ImageStoreConfig
+from madlibs_module.madlibs_tracing import tracer
+
+_IMAGE_NAME = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9._-]*$")
+
+
+class InvalidImageNameException(Exception):
+    pass
+
+
+class ImageStore(ABC):
+    """Where generated image files live, keyed by file name"""
+
+    @staticmethod
+    def check_name(name: str) -> str:
+        # Names come straight from URLs, so never let one escape the store
+        if not _IMAGE_NAME.match(name):
+            raise InvalidImageNameException(f"Invalid image name: {name}")
+        return name
+
+    @abstractmethod
+    async def write(self, name: str, data: bytes):
+        pass
+
+    @abstractmethod
+    async def read(self, name: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    async def exists(self, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def delete(self, name: str):
+        pass
+
+    def local_path(self, name: str) -> Optional[Path]:
+        """Path on this machine for serving the file directly, if there is one"""
+        return None
+
+    async def close(self):
+        pass
+
+
+class LocalImageStore(ImageStore):
+    """
+    Images in a directory. Point every worker at the same directory (or a
+    network mount for several nodes) to share it.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def local_path(self, name: str) -> Optional[Path]:
+        return self.directory / self.check_name(name)
+
+    async def write(self, name: str, data: bytes):
+        await asyncio.to_thread(self._write, self.local_path(name), data)
+
+    def _write(self, path: Path, data: bytes):
+        # Write to a unique temp file and rename so readers never see a partial image
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        with tracer.start_as_current_span(
+            "image_store.write",
+            attributes={
+                "madlibs.image.name": path.name,
+                "madlibs.image.bytes": len(data),
+            },
+        ):
+            try:
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+
+    async def read(self, name: str) -> Optional[bytes]:
+        path = self.local_path(name)
+        try:
+            return await asyncio.to_thread(path.read_bytes)
+        except FileNotFoundError:
+            return None
+
+    async def exists(self, name: str) -> bool:
+        return await asyncio.to_thread(self.local_path(name).is_file)
+
+    async def delete(self, name: str):
+        await asyncio.to_thread(self.local_path(name).unlink, missing_ok=True)
+
+
+class RedisImageStore(ImageStore):
+    """Images as blobs on a Redis-compatible server, for nodes without a shared disk"""
+
+    def __init__(self, url: str, ttl_seconds: float, key_prefix: str = "madlibs"):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self._prefix = f"{key_prefix}:images"
+
+    def _key(self, name: str) -> str:
+        return f"{self._prefix}:{self.check_name(name)}"
+
+    async def write(self, name: str, data: bytes):
+        with tracer.start_as_current_span(
+            "image_store.write",
+            attributes={"madlibs.image.name": name, "madlibs.image.bytes": len(data)},
+        ):
+            await self.client.set(
+                self._key(name), data, ex=int(self.ttl_seconds) or None
+            )
+
+    async def read(self, name: str) -> Optional[bytes]:
+        return await self.client.get(self._key(name))
+
+    async def exists(self, name: str) -> bool:
+        return bool(await self.client.exists(self._key(name)))
+
+    async def delete(self, name: str):
+        await self.client.delete(self._key(name))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_image_store(config: ImageStoreConfig) -> ImageStore:
+    if config.backend == "local":
+        return LocalImageStore(config.directory)
+    if config.backend == "redis":
+        return RedisImageStore(config.redis_url, ttl_seconds=config.ttl_seconds)
+    raise ValueError(f"Unknown image store backend: {config.backend}")
@@ -0,0 +1,188 @@
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+import asyncio
+import logging
+import time
+import uuid
+from madlibs_module.madlibs_store import RecordStore
+from madlibs_module.madlibs_tracing import current_trace_ref, link_to_record, tracer
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFullException(Exception):
+    pass
+
+
+class ImageJob:
+    def __init__(self, madlib_id: str):
+        self.job_id = str(uuid.uuid4())
+        self.madlib_id = madlib_id
+        self.status = "queued"
+        self.image_url: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.done = asyncio.Event()
+        # The request that queued the job, so its span can link back to it
+        self.trace = current_trace_ref()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "madlib_id": self.madlib_id,
+            "status": self.status,
+            "image_url": self.image_url,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class ImageJobQueue:
+    """
+    Bounded queue of image generation jobs drained by a fixed pool of
+    asyncio workers. Finished jobs are kept around for status polling until
+    they age out or the retention limit is hit. Job state is also written to
+    the given record store, so with a shared store any worker can report on
+    a job that another worker is running.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str], Awaitable[dict]],
+        workers: int,
+        max_queue: int,
+        retention_seconds: float,
+        max_jobs: int,
+        store: Optional[RecordStore] = None,
+        poll_interval: float = 0.5,
+    ):
+        self.handler = handler
+        self.store = store
+        self.poll_interval = poll_interval
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retention_seconds = retention_seconds
+        self.max_jobs = max_jobs
+        self.jobs: "OrderedDict[str, ImageJob]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [
+            asyncio.create_task(self._worker(i)) for i in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} image job workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, madlib_id: str) -> ImageJob:
+        self.start()
+        self._prune()
+        if self._queue.full():
+            self._rejected += 1
+            raise JobQueueFullException("Image job queue is full")
+        job = ImageJob(madlib_id)
+        # Record the job before a worker can pick it up and move it on
+        await self._save(job)
+        self.jobs[job.job_id] = job
+        self._queue.put_nowait(job)
+        return job
+
+    async def status(self, job_id: str, wait: float = 0) -> Optional[dict]:
+        """
+        Current state of a job, waiting up to `wait` seconds for it to finish
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            if not job.finished and wait > 0:
+                try:
+                    await asyncio.wait_for(job.done.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            return job.to_dict()
+
+        if self.store is None:
+            return None
+        # Another worker owns this job, so all we can do is poll the store
+        deadline = time.monotonic() + wait
+        while True:
+            record = await self.store.get(job_id)
+            if record is None or record["status"] in ("done", "failed"):
+                return record
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return record
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+    async def _save(self, job: ImageJob):
+        if self.store is not None:
+            await self.store.put(job.job_id, job.to_dict())
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.updated_at = time.time()
+            self._running += 1
+            try:
+                await self._save(job)
+                with tracer.start_as_current_span("image_job"):
+                    link_to_record({"trace": job.trace}, job_id=job.job_id)
+                    result = await self.handler(job.madlib_id)
+                job.image_url = result["image_url"]
+                job.status = "done"
+                self._completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Image job {job.job_id} failed: {str(e)}")
+                job.error = getattr(e, "detail", None) or str(e)
+                job.status = "failed"
+                self._failed += 1
+            finally:
+                self._running -= 1
+                job.updated_at = time.time()
+                job.done.set()
+                self._queue.task_done()
+            try:
+                await self._save(job)
+            except Exception as e:
+                logger.error(f"Error saving image job {job.job_id}: {str(e)}")
+
+    def _prune(self):
+        # Jobs are inserted in creation order, so expired ones sit at the front
+        cutoff = time.time() - self.retention_seconds
+        for job_id, job in list(self.jobs.items()):
+            if len(self.jobs) < self.max_jobs and job.created_at >= cutoff:
+                break
+            if job.finished:
+                del self.jobs[job_id]
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "running": self._running,
+            "completed": self._completed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+            "tracked_jobs": len(self.jobs),
+        }
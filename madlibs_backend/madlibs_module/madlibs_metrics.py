@@ -0,0 +1,287 @@
+from contextlib import contextmanager
+import time
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+# Provider calls take seconds, so the buckets reach well past the defaults
+_STAGE_BUCKETS = (
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    20.0,
+    30.0,
+    60.0,
+)
+
+
+class MadLibsMetrics:
+    """
+    Prometheus metrics for one API instance, kept in their own registry so
+    several instances (or tests) in one process don't collide. With several
+    uvicorn workers each worker reports its own numbers.
+    """
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.requests = Counter(
+            "madlibs_http_requests_total",
+            "HTTP requests handled, by route and status code",
+            ["method", "route", "status"],
+            registry=self.registry,
+        )
+        self.request_latency = Histogram(
+            "madlibs_http_request_duration_seconds",
+            "Time from receiving a request to finishing its response",
+            ["method", "route"],
+            buckets=_STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.requests_in_flight = Gauge(
+            "madlibs_http_requests_in_flight",
+            "Requests currently being handled",
+            registry=self.registry,
+        )
+        self.stage_latency = Histogram(
+            "madlibs_stage_duration_seconds",
+            "Time spent in each pipeline stage, by outcome",
+            ["stage", "outcome"],
+            buckets=_STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.stage_wait = Histogram(
+            "madlibs_stage_queue_wait_seconds",
+            "Time provider calls waited for a free stage worker",
+            ["stage"],
+            buckets=_STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.stage_in_flight = Gauge(
+            "madlibs_stage_in_flight",
+            "Pipeline stage calls currently running",
+            ["stage"],
+            registry=self.registry,
+        )
+        self.stage_queued = Gauge(
+            "madlibs_stage_queued",
+            "Provider calls waiting for a free stage worker",
+            ["stage"],
+            registry=self.registry,
+        )
+        self.store_items = Gauge(
+            "madlibs_store_items",
+            "Records held by each store",
+            ["store"],
+            registry=self.registry,
+        )
+        self.cache_items = Gauge(
+            "madlibs_cache_items",
+            "Entries held by each cache",
+            ["cache"],
+            registry=self.registry,
+        )
+        self.cache_hit_ratio = Gauge(
+            "madlibs_cache_hit_ratio",
+            "Share of lookups answered by each cache or store since startup",
+            ["cache"],
+            registry=self.registry,
+        )
+        self.admission_shed = Counter(
+            "madlibs_admission_shed_total",
+            "Requests rejected with a 503 by admission control",
+            ["route", "reason"],
+            registry=self.registry,
+        )
+        self.admission_wait = Histogram(
+            "madlibs_admission_queue_wait_seconds",
+            "Time admitted requests waited for a slot",
+            ["route"],
+            buckets=_STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.admission_in_flight = Gauge(
+            "madlibs_admission_in_flight",
+            "Requests holding an admission slot, by route group",
+            ["group"],
+            registry=self.registry,
+        )
+        self.admission_queued = Gauge(
+            "madlibs_admission_queued",
+            "Requests waiting for an admission slot, by route group",
+            ["group"],
+            registry=self.registry,
+        )
+        self.provider_events = Counter(
+            "madlibs_provider_events_total",
+            "Retries, timeouts, failures, hedges and short circuits per stage",
+            ["stage", "event"],
+            registry=self.registry,
+        )
+        self.breaker_open = Gauge(
+            "madlibs_circuit_breaker_open",
+            "1 while a stage's circuit breaker is open or half open",
+            ["stage"],
+            registry=self.registry,
+        )
+        self.client_disconnects = Counter(
+            "madlibs_client_disconnects_total",
+            "Requests cancelled because the client went away before the response",
+            ["route"],
+            registry=self.registry,
+        )
+        self.cancelled_work = Counter(
+            "madlibs_cancelled_work_total",
+            "Shared provider work cancelled once nobody was waiting for it",
+            ["work"],
+            registry=self.registry,
+        )
+        self.template_checks = Counter(
+            "madlibs_template_checks_total",
+            "Generated templates by check result: valid, repaired locally, "
+            "regenerated or failed",
+            ["result"],
+            registry=self.registry,
+        )
+        self.image_optimizations = Counter(
+            "madlibs_image_optimizations_total",
+            "Background image re-encodes, by result",
+            ["result"],
+            registry=self.registry,
+        )
+        self.image_bytes_saved = Counter(
+            "madlibs_image_bytes_saved_total",
+            "Bytes of image storage saved by background re-encoding",
+            registry=self.registry,
+        )
+        self.image_size_ratio = Histogram(
+            "madlibs_image_optimized_size_ratio",
+            "Size of each re-encoded image as a fraction of the original",
+            buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+            registry=self.registry,
+        )
+        self.image_jobs = Gauge(
+            "madlibs_image_jobs",
+            "Image jobs by state",
+            ["state"],
+            registry=self.registry,
+        )
+
+    def observe_stage(
+        self, stage: str, run_seconds: float, failed: bool, wait_seconds: float = 0
+    ):
+        self.stage_latency.labels(stage, "error" if failed else "success").observe(
+            run_seconds
+        )
+        if wait_seconds:
+            self.stage_wait.labels(stage).observe(wait_seconds)
+
+    @contextmanager
+    def time_stage(self, stage: str):
+        """Time the enclosed block (awaits included) as one call of a stage"""
+        in_flight = self.stage_in_flight.labels(stage)
+        in_flight.inc()
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            in_flight.dec()
+            self.observe_stage(stage, time.perf_counter() - start, failed)
+
+    def observe_admission(self, route: str, wait_seconds: float, reason=None):
+        if reason is None:
+            self.admission_wait.labels(route).observe(wait_seconds)
+        else:
+            self.admission_shed.labels(route, reason).inc()
+
+    def observe_provider_event(self, stage: str, event: str):
+        self.provider_events.labels(stage, event).inc()
+
+    def observe_disconnect(self, route: str):
+        self.client_disconnects.labels(route).inc()
+
+    def observe_cancelled_work(self, work: str):
+        self.cancelled_work.labels(work).inc()
+
+    def observe_template_check(self, result: str):
+        self.template_checks.labels(result).inc()
+
+    def observe_image_optimization(
+        self, result: str, bytes_before: int = 0, bytes_after: int = 0
+    ):
+        self.image_optimizations.labels(result).inc()
+        if bytes_before:
+            self.image_bytes_saved.inc(bytes_before - bytes_after)
+            self.image_size_ratio.observe(bytes_after / bytes_before)
+
+    def set_cache(self, cache: str, size: int, hit_ratio: float):
+        self.cache_items.labels(cache).set(size)
+        self.cache_hit_ratio.labels(cache).set(hit_ratio)
+
+    def render(self) -> bytes:
+        return generate_latest(self.registry)
+
+    content_type = CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests and timing them per route template
+    (/api/jobs/{job_id}, not the raw path) until the last byte of the
+    response, so streamed responses are timed in full
+    """
+
+    def __init__(self, app, metrics: MadLibsMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.metrics.requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.metrics.requests_in_flight.dec()
+            if scope.get("madlibs.client_disconnected"):
+                # nginx's code for a request the client gave up on
+                status = 499
+            # The route is only known once the router has matched it
+            route = _route(scope)
+            self.metrics.requests.labels(method, route, str(status)).inc()
+            self.metrics.request_latency.labels(method, route).observe(
+                time.perf_counter() - start
+            )
+
+
+def _route(scope) -> str:
+    route = scope.get("route")
+    # Unmatched paths share one label so scanners can't blow up cardinality
+    return getattr(route, "path", None) or "unmatched"
@@ -0,0 +1,265 @@
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+import asyncio
+import logging
+import random
+import time
+import httpx
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitOpenException(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} provider is unavailable, try again later")
+        self.retry_after = retry_after
+
+
+class ProviderTimeoutException(Exception):
+    pass
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether a failed provider call is worth retrying: timeouts, connection
+    errors, rate limits and server errors. Anything else (bad requests, auth
+    errors, an image that wasn't generated) would fail the same way again
+    """
+    if isinstance(
+        error,
+        (ProviderTimeoutException, TimeoutError, ConnectionError, httpx.TransportError),
+    ):
+        return True
+    # litellm errors carry status_code, google-genai errors carry code
+    status = getattr(error, "status_code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "code", None)
+    if not isinstance(status, int):
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+    return isinstance(status, int) and (status in (408, 429) or status >= 500)
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and fails calls fast
+    for reset_seconds. After that a single trial call is let through: success
+    closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.opens = 0
+
+    def retry_after(self) -> float:
+        return max(self._opened_at + self.reset_seconds - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and self.retry_after() > 0:
+            return False
+        if self._trial_running:
+            return False
+        self.state = "half_open"
+        self._trial_running = True
+        return True
+
+    def abandon_trial(self):
+        """The trial call was cancelled before it said anything either way"""
+        if self.state == "half_open":
+            self._trial_running = False
+
+    def record_success(self):
+        self.state = "closed"
+        self._failures = 0
+        self._trial_running = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_running = False
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+class ResiliencePolicy:
+    """
+    Wraps the provider calls of one stage with a per-attempt timeout,
+    retries of transient failures with full-jitter exponential backoff and a
+    circuit breaker. With hedging on, an attempt that is still running after
+    the p95 of recent call latencies gets a second, identical call fired next
+    to it and whichever answers first wins. Calls are async callables taking
+    an on_start callback, which they call once the provider call itself
+    begins: the timeout, the latencies and the hedge delay are all measured
+    from there, so time spent queueing for a local worker never counts
+    against the provider. Calls that can't be repeated, like a stream whose
+    tokens have already gone out, get a single attempt and no hedge. Any
+    provider (or a fake one with injected latency) can be wrapped.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout_seconds: float,
+        retries: int,
+        backoff_base: float,
+        backoff_max: float,
+        breaker: CircuitBreaker,
+        hedge: bool = False,
+        hedge_min_delay: float = 0.0,
+        hedge_min_samples: int = 20,
+        on_event: Optional[Callable[[str, str], None]] = None,
+    ):
+        self.name = name
+        self.timeout_seconds = timeout_seconds
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.on_event = on_event
+        self._latencies = deque(maxlen=200)
+        self.events = {
+            "retry": 0,
+            "timeout": 0,
+            "failure": 0,
+            "rejected": 0,
+            "short_circuit": 0,
+            "hedge": 0,
+            "hedge_win": 0,
+        }
+
+    async def call(
+        self, fn: Callable[[Callable[[], None]], Awaitable[T]], replayable: bool = True
+    ) -> T:
+        retries = self.retries if replayable else 0
+        for attempt in range(retries + 1):
+            if not self.breaker.allow():
+                self._event("short_circuit")
+                raise CircuitOpenException(self.name, self.breaker.retry_after())
+            try:
+                result = await self._attempt(fn, hedge=replayable)
+            except asyncio.CancelledError:
+                # The caller gave up; that says nothing about the provider
+                self.breaker.abandon_trial()
+                raise
+            except Exception as e:
+                if not is_transient(e):
+                    # The provider answered, it just won't do this call
+                    self.breaker.record_success()
+                    self._event("rejected")
+                    raise
+                self.breaker.record_failure()
+                self._event("failure")
+                if attempt == retries or self.breaker.state == "open":
+                    raise
+                delay = random.uniform(
+                    0, min(self.backoff_max, self.backoff_base * 2**attempt)
+                )
+                logger.warning(
+                    f"{self.name} call failed ({str(e)}), retrying in {delay:.2f}s"
+                )
+                self._event("retry")
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def _attempt(self, fn, hedge: bool) -> T:
+        delay = self._hedge_delay() if hedge else None
+        if delay is None:
+            return await self._timed_call(fn)
+        return await self._hedged_call(fn, delay)
+
+    async def _timed_call(self, fn, started: Optional[asyncio.Future] = None) -> T:
+        """
+        Run one call, timing it out timeout_seconds after it starts. started
+        (a future set to the start time) lets the caller see when that is
+        """
+        if started is None:
+            started = asyncio.get_running_loop().create_future()
+
+        def on_start():
+            if not started.done():
+                started.set_result(time.perf_counter())
+
+        call = asyncio.ensure_future(fn(on_start))
+        try:
+            # No deadline while the call waits for a local worker
+            await asyncio.wait({call, started}, return_when=asyncio.FIRST_COMPLETED)
+            if started.done():
+                remaining = self.timeout_seconds - (
+                    time.perf_counter() - started.result()
+                )
+                await asyncio.wait({call}, timeout=max(remaining, 0))
+            if not call.done():
+                self._event("timeout")
+                raise ProviderTimeoutException(
+                    f"{self.name} call timed out after {self.timeout_seconds}s"
+                )
+            result = call.result()
+        finally:
+            call.cancel()
+        if started.done():
+            self._latencies.append(time.perf_counter() - started.result())
+        return result
+
+    async def _hedged_call(self, fn, delay: float) -> T:
+        started = asyncio.get_running_loop().create_future()
+        primary = asyncio.create_task(self._timed_call(fn, started))
+        tasks = {primary}
+        try:
+            # The hedge clock starts with the provider call, not in the queue
+            await asyncio.wait({primary, started}, return_when=asyncio.FIRST_COMPLETED)
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self._event("hedge")
+                tasks.add(asyncio.create_task(self._timed_call(fn)))
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._event("hedge_win")
+                        return task.result()
+                    if not tasks:
+                        raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        return max(p95, self.hedge_min_delay)
+
+    def _event(self, event: str):
+        self.events[event] += 1
+        if self.on_event is not None:
+            self.on_event(self.name, event)
+
+    def stats(self) -> dict:
+        hedge_delay = self._hedge_delay()
+        return {
+            "breaker": self.breaker.state,
+            "breaker_opens": self.breaker.opens,
+            "hedge_delay_ms": (
+                round(1000 * hedge_delay, 1) if hedge_delay is not None else None
+            ),
+            **self.events,
+        }
@@ -0,0 +1,101 @@
+from typing import Awaitable, Callable, Dict, Optional
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task, detached: bool):
+        self.task = task
+        self.detached = detached
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key onto one in-flight task, so a
+    double click or a client retry costs one provider call instead of two.
+    Callers that arrive while a call is running wait for its result (or
+    exception) instead of starting their own. The shared call is cancelled
+    only once every caller waiting on it has gone away; on_cancel, if given,
+    is then called with the flight's name.
+    """
+
+    def __init__(self, name: str, on_cancel: Optional[Callable[[str], None]] = None):
+        self.name = name
+        self.on_cancel = on_cancel
+        self._flights: Dict[str, _Flight] = {}
+        self.calls = 0
+        self.shared = 0
+        self.cancelled = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._flights
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        """Await fn() for this key, or the call already running for it"""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._launch(key, fn, detached=False)
+        else:
+            self.shared += 1
+        flight.waiters += 1
+        try:
+            # Shielded so one caller giving up doesn't cancel it for the others
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.detached and not flight.task.done():
+                self._cancel(key, flight)
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def start(self, key: str, fn: Callable[[], Awaitable]) -> Optional[asyncio.Task]:
+        """
+        Run fn() in the background under this key without waiting on it.
+        Nobody waiting on it isn't a reason to cancel it, so it runs until it
+        finishes or cancel() is called. Returns None if the key is already busy
+        """
+        if key in self._flights:
+            return None
+        return self._launch(key, fn, detached=True).task
+
+    def cancel(self, key: str) -> bool:
+        flight = self._flights.get(key)
+        if flight is None or flight.task.done():
+            return False
+        self._cancel(key, flight)
+        return True
+
+    def _launch(self, key: str, fn: Callable[[], Awaitable], detached: bool):
+        flight = _Flight(asyncio.create_task(fn()), detached)
+        self._flights[key] = flight
+        self.calls += 1
+
+        def finished(task: asyncio.Task):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        flight.task.add_done_callback(finished)
+        return flight
+
+    def _cancel(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        flight.task.cancel()
+        self.cancelled += 1
+        if self.on_cancel is not None:
+            self.on_cancel(self.name)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "calls": self.calls,
+            # Every shared wait is a provider call that didn't happen
+            "saved_calls": self.shared,
+            "cancelled": self.cancelled,
+        }
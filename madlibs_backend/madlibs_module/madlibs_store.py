@@ -0,0 +1,372 @@
+from abc import ABC, abstractmethod
+from typing import Optional
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from madlibs_module.madlibs_cache import LRUCache
+from madlibs_module.madlibs_config import StoreConfig
+
+logger = logging.getLogger(__name__)
+
+
+class RecordStore(ABC):
+    """Key/value store for the JSON-able records behind templates and madlibs"""
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def put(self, key: str, record: dict):
+        pass
+
+    @abstractmethod
+    async def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    async def stats(self) -> dict:
+        pass
+
+    async def close(self):
+        pass
+
+
+class MemoryRecordStore(RecordStore):
+    """Per-process store bounded by item count and record age"""
+
+    def __init__(self, namespace: str, max_items: int, ttl_seconds: float):
+        super().__init__(namespace)
+        self._cache = LRUCache(max_items=max_items, ttl_seconds=ttl_seconds)
+
+    async def get(self, key: str) -> Optional[dict]:
+        return self._cache.get(key)
+
+    async def put(self, key: str, record: dict):
+        self._cache.put(key, record)
+
+    async def delete(self, key: str):
+        self._cache.pop(key)
+
+    async def stats(self) -> dict:
+        return {"backend": "memory", **self._cache.stats()}
+
+
+class SQLiteRecordStore(RecordStore):
+    """
+    Durable store on a WAL-mode SQLite database. Writes and LRU access-time
+    updates are buffered and flushed in batches, either when batch_size is
+    reached or every flush_interval seconds from a background thread. The
+    buffers have their own lock, only ever held for a dict operation, so the
+    event loop never waits behind a flush; the connection's lock is only
+    taken from worker threads.
+    """
+
+    _CREATE = (
+        "CREATE TABLE IF NOT EXISTS records ("
+        "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+        "created_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+        "PRIMARY KEY (namespace, key))"
+    )
+    _INDEX = (
+        "CREATE INDEX IF NOT EXISTS records_lru ON records (namespace, accessed_at)"
+    )
+    _SELECT = "SELECT value, created_at FROM records WHERE namespace = ? AND key = ?"
+    _UPSERT = (
+        "INSERT OR REPLACE INTO records "
+        "(namespace, key, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)"
+    )
+    _TOUCH = "UPDATE records SET accessed_at = ? WHERE namespace = ? AND key = ?"
+    _DELETE = "DELETE FROM records WHERE namespace = ? AND key = ?"
+    _EXPIRE = "DELETE FROM records WHERE namespace = ? AND created_at < ?"
+    _COUNT = "SELECT COUNT(*) FROM records WHERE namespace = ?"
+    _EVICT = (
+        "DELETE FROM records WHERE namespace = ? AND key IN ("
+        "SELECT key FROM records WHERE namespace = ? "
+        "ORDER BY accessed_at LIMIT ?)"
+    )
+
+    def __init__(
+        self,
+        namespace: str,
+        path: str,
+        max_items: int,
+        ttl_seconds: float,
+        batch_size: int,
+        flush_interval: float,
+    ):
+        super().__init__(namespace)
+        self.path = path
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Guards _pending and _touched
+        self._buffer_lock = threading.Lock()
+        # Guards the connection, and is held for the whole of a flush
+        self._conn_lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, cached_statements=64
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(self._CREATE)
+        self._conn.execute(self._INDEX)
+        # Records waiting to be written: key -> (value, created_at)
+        self._pending: dict[str, tuple[str, float]] = {}
+        self._touched: dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.flushes = 0
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name=f"madlibs-sqlite-{namespace}", daemon=True
+        )
+        self._flusher.start()
+
+    async def get(self, key: str) -> Optional[dict]:
+        with self._buffer_lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            return self._check_hit(key, *pending)
+        row = await asyncio.to_thread(self._select, key)
+        if row is None:
+            self.misses += 1
+            return None
+        return self._check_hit(key, *row)
+
+    def _check_hit(self, key: str, value: str, created_at: float) -> Optional[dict]:
+        now = time.time()
+        if self.ttl_seconds and created_at < now - self.ttl_seconds:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._buffer_lock:
+            self._touched[key] = now
+        return json.loads(value)
+
+    def _select(self, key: str):
+        # A record being flushed has left _pending but isn't committed yet;
+        # waiting on the flush here is what keeps it from looking missing
+        with self._conn_lock:
+            return self._conn.execute(self._SELECT, (self.namespace, key)).fetchone()
+
+    async def put(self, key: str, record: dict):
+        value = json.dumps(record)
+        with self._buffer_lock:
+            self._pending[key] = (value, time.time())
+            full = len(self._pending) >= self.batch_size
+        if full:
+            await asyncio.to_thread(self.flush)
+
+    async def delete(self, key: str):
+        with self._buffer_lock:
+            self._pending.pop(key, None)
+            self._touched.pop(key, None)
+        await asyncio.to_thread(self._delete, key)
+
+    def _delete(self, key: str):
+        with self._conn_lock:
+            self._conn.execute(self._DELETE, (self.namespace, key))
+
+    def flush(self):
+        with self._conn_lock:
+            with self._buffer_lock:
+                if not self._pending and not self._touched:
+                    return
+                pending, self._pending = self._pending, {}
+                touched, self._touched = self._touched, {}
+            try:
+                self._write_batch(pending, touched)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                # Put the batch back so the next flush retries it
+                with self._buffer_lock:
+                    self._pending = {**pending, **self._pending}
+                    self._touched = {**touched, **self._touched}
+                raise
+
+    def _write_batch(self, pending: dict, touched: dict):
+        self._conn.execute("BEGIN")
+        self._conn.executemany(
+            self._UPSERT,
+            [
+                (self.namespace, key, value, created_at, created_at)
+                for key, (value, created_at) in pending.items()
+            ],
+        )
+        self._conn.executemany(
+            self._TOUCH,
+            [
+                (accessed_at, self.namespace, key)
+                for key, accessed_at in touched.items()
+                if key not in pending
+            ],
+        )
+        if self.ttl_seconds:
+            cursor = self._conn.execute(
+                self._EXPIRE, (self.namespace, time.time() - self.ttl_seconds)
+            )
+            self.expirations += cursor.rowcount
+        if self.max_items:
+            (count,) = self._conn.execute(self._COUNT, (self.namespace,)).fetchone()
+            if count > self.max_items:
+                cursor = self._conn.execute(
+                    self._EVICT,
+                    (self.namespace, self.namespace, count - self.max_items),
+                )
+                self.evictions += cursor.rowcount
+        self._conn.execute("COMMIT")
+        self.flushes += 1
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing {self.namespace} records: {str(e)}")
+
+    async def stats(self) -> dict:
+        def count():
+            with self._conn_lock:
+                (size,) = self._conn.execute(self._COUNT, (self.namespace,)).fetchone()
+                return size
+
+        size = await asyncio.to_thread(count)
+        with self._buffer_lock:
+            pending_writes = len(self._pending)
+        lookups = self.hits + self.misses
+        return {
+            "backend": "sqlite",
+            "size": size + pending_writes,
+            "max_items": self.max_items,
+            "pending_writes": pending_writes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "flushes": self.flushes,
+        }
+
+    async def close(self):
+        self._closed.set()
+        await asyncio.to_thread(self.flush)
+        await asyncio.to_thread(self._close)
+
+    def _close(self):
+        with self._conn_lock:
+            self._conn.close()
+
+
+class RedisRecordStore(RecordStore):
+    """
+    Store on a Redis-compatible server, shared by every worker and node
+    pointing at the same URL. A sorted set per namespace tracks last access
+    so the store can be capped by max_items like the other backends.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        url: str,
+        max_items: int,
+        ttl_seconds: float,
+        key_prefix: str = "madlibs",
+    ):
+        super().__init__(namespace)
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self._prefix = f"{key_prefix}:{namespace}"
+        self._index = f"{self._prefix}:index"
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, key: str) -> str:
+        return f"{self._prefix}:{key}"
+
+    async def get(self, key: str) -> Optional[dict]:
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(self._key(key))
+            pipe.zadd(self._index, {key: time.time()}, xx=True)
+            value, _ = await pipe.execute()
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    async def put(self, key: str, record: dict):
+        now = time.time()
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.set(
+                self._key(key), json.dumps(record), ex=int(self.ttl_seconds) or None
+            )
+            pipe.zadd(self._index, {key: now})
+            if self.ttl_seconds:
+                # The records themselves expire on their own; drop their index entries
+                pipe.zremrangebyscore(self._index, "-inf", now - self.ttl_seconds)
+            pipe.zcard(self._index)
+            size = (await pipe.execute())[-1]
+        if self.max_items and size > self.max_items:
+            evicted = await self.client.zpopmin(self._index, size - self.max_items)
+            if evicted:
+                await self.client.delete(*[self._key(k.decode()) for k, _ in evicted])
+                self.evictions += len(evicted)
+
+    async def delete(self, key: str):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(self._key(key))
+            pipe.zrem(self._index, key)
+            await pipe.execute()
+
+    async def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "redis",
+            "size": await self.client.zcard(self._index),
+            "max_items": self.max_items,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_record_store(config: StoreConfig, namespace: str) -> RecordStore:
+    if config.backend == "memory":
+        return MemoryRecordStore(
+            namespace, max_items=config.max_items, ttl_seconds=config.ttl_seconds
+        )
+    if config.backend == "sqlite":
+        return SQLiteRecordStore(
+            namespace,
+            path=config.sqlite_path,
+            max_items=config.max_items,
+            ttl_seconds=config.ttl_seconds,
+            batch_size=config.batch_size,
+            flush_interval=config.flush_interval,
+        )
+    if config.backend == "redis":
+        return RedisRecordStore(
+            namespace,
+            url=config.redis_url,
+            max_items=config.max_items,
+            ttl_seconds=config.ttl_seconds,
+        )
+    raise ValueError(f"Unknown store backend: {config.backend}")
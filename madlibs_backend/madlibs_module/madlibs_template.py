@@ -19,3 +19,7 @@ class MadLibsTemplateModule(dspy.Module):
     def forward(self, topic):
         result = self.generate_template(topic=topic)
         return result
+
+    async def aforward(self, topic):
+        result = await self.generate_template.acall(topic=topic)
+        return result
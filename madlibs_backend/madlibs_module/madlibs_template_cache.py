@@ -0,0 +1,187 @@
+from collections import Counter, defaultdict
+from typing import Dict, Optional, Set
+import math
+import random
+import re
+import threading
+from madlibs_module.madlibs_cache import LRUCache
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+def _stem(word: str) -> str:
+    # A few suffix rules are enough to fold plurals and verb forms together
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith("sses"):
+        return word[:-2]
+    if len(word) > 4 and word.endswith(("xes", "zes", "ches", "shes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us")):
+        return word[:-1]
+    if len(word) > 5 and word.endswith("ing"):
+        return word[:-3]
+    if len(word) > 4 and word.endswith("ed"):
+        return word[:-2]
+    return word
+
+
+def normalize_topic(topic: str) -> str:
+    """Fold case, punctuation, whitespace and simple inflections out of a topic"""
+    words = _PUNCTUATION.sub(" ", topic.lower()).split()
+    return " ".join(_stem(word) for word in words)
+
+
+def _trigrams(text: str) -> Counter:
+    padded = f"  {text} "
+    return Counter(padded[i : i + 3] for i in range(len(padded) - 2))
+
+
+class TemplateCache:
+    """
+    Caches generated templates by normalized topic. Each topic collects up to
+    `variants` different templates before lookups start answering from the
+    cache, so popular topics still get some variety. When fuzzy matching is
+    on, a topic with no entry of its own can borrow the entry of the most
+    similar cached topic (TF-IDF cosine over character trigrams) if it scores
+    at least `similarity_threshold`. Cached topics are indexed by trigram as
+    they are added, so a lookup only weighs the query and the topics sharing
+    a trigram with it.
+    """
+
+    def __init__(
+        self,
+        variants: int,
+        max_topics: int,
+        ttl_seconds: float,
+        fuzzy: bool,
+        similarity_threshold: float,
+    ):
+        self.variants = max(variants, 1)
+        self.fuzzy = fuzzy
+        self.similarity_threshold = similarity_threshold
+        self._cache = LRUCache(max_items=max_topics, ttl_seconds=ttl_seconds)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+        # Trigram index of the cached topics, guarded by _lock
+        self._key_grams: Dict[str, Counter] = {}
+        self._postings: Dict[str, Set[str]] = defaultdict(set)
+        self._doc_freq = Counter()
+        self._vectors: Dict[str, Dict[str, float]] = {}
+        self._weighted_size = 0
+
+    def lookup(self, topic: str) -> Optional[dict]:
+        """
+        A cached {"template", "word_types", "compiled"} for the topic, or None when a new
+        one should be generated (and handed to add)
+        """
+        key = normalize_topic(topic)
+        variants = self._cache.get(key)
+        fuzzy = False
+        if variants is None and self.fuzzy:
+            with self._lock:
+                similar_key = self._most_similar(key)
+            if similar_key is not None:
+                variants = self._cache.get(similar_key)
+                fuzzy = variants is not None
+                if not fuzzy:
+                    # Evicted or expired since it was indexed
+                    with self._lock:
+                        self._unindex(similar_key)
+        with self._lock:
+            if variants is None or len(variants) < self.variants:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if fuzzy:
+                self.fuzzy_hits += 1
+            return random.choice(variants)
+
+    def add(self, topic: str, template: dict):
+        key = normalize_topic(topic)
+        with self._lock:
+            variants = self._cache.get(key) or []
+            if len(variants) < self.variants:
+                self._cache.put(key, variants + [template])
+                if self.fuzzy:
+                    self._index(key)
+
+    def _index(self, key: str):
+        if not key or key in self._key_grams:
+            return
+        grams = _trigrams(key)
+        self._key_grams[key] = grams
+        for gram in grams:
+            self._postings[gram].add(key)
+        self._doc_freq.update(grams.keys())
+        # Document frequencies drift as topics come and go, so every vector
+        # is reweighted once the index has grown by a tenth since the last
+        # time, which keeps adds cheap on average
+        if len(self._key_grams) > self._weighted_size * 1.1 + 8:
+            self._reweight()
+        else:
+            self._vectors[key] = self._vector(grams)
+
+    def _unindex(self, key: str):
+        grams = self._key_grams.pop(key, None)
+        if grams is None:
+            return
+        for gram in grams:
+            keys = self._postings[gram]
+            keys.discard(key)
+            if not keys:
+                del self._postings[gram]
+        self._doc_freq.subtract(grams.keys())
+        self._vectors.pop(key, None)
+
+    def _reweight(self):
+        # Also a chance to drop topics the LRU has evicted since
+        live = set(self._cache.keys())
+        for key in [key for key in self._key_grams if key not in live]:
+            self._unindex(key)
+        self._vectors = {
+            key: self._vector(grams) for key, grams in self._key_grams.items()
+        }
+        self._weighted_size = len(self._key_grams)
+
+    def _vector(self, counts: Counter) -> Dict[str, float]:
+        total = len(self._key_grams) + 1
+        weights = {
+            gram: count * (math.log(total / (self._doc_freq[gram] + 1)) + 1)
+            for gram, count in counts.items()
+        }
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        return {gram: w / norm for gram, w in weights.items()}
+
+    def _most_similar(self, key: str) -> Optional[str]:
+        if not self._key_grams or not key:
+            return None
+        query = self._vector(_trigrams(key))
+        # Only topics sharing a trigram with the query can score above zero
+        scores: Dict[str, float] = defaultdict(float)
+        for gram, weight in query.items():
+            for candidate in self._postings.get(gram, ()):
+                scores[candidate] += weight * self._vectors[candidate][gram]
+        if not scores:
+            return None
+        best_key = max(scores, key=scores.get)
+        if scores[best_key] >= self.similarity_threshold:
+            return best_key
+        return None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        cache_stats = self._cache.stats()
+        return {
+            "topics": cache_stats["size"],
+            "max_topics": cache_stats["max_items"],
+            "variants_per_topic": self.variants,
+            "hits": self.hits,
+            "fuzzy_hits": self.fuzzy_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": cache_stats["evictions"],
+            "expirations": cache_stats["expirations"],
+        }
@@ -0,0 +1,150 @@
+from typing import Optional
+import logging
+import threading
+from dspy.utils.callback import BaseCallback
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    SpanExporter,
+    SpanExportResult,
+)
+from madlibs_module.madlibs_config import TracingConfig
+
+logger = logging.getLogger(__name__)
+
+# Spans go nowhere until configure_tracing installs a provider
+tracer = trace.get_tracer("madlibs")
+
+_provider: Optional[TracerProvider] = None
+
+
+class JsonFileSpanExporter(SpanExporter):
+    """Appends finished spans to a file, one JSON object per line"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans) -> SpanExportResult:
+        lines = "".join(span.to_json(indent=None) + "\n" for span in spans)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+        except OSError as e:
+            logger.error(f"Error writing spans to {self.path}: {str(e)}")
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def configure_tracing(config: TracingConfig) -> Optional[TracerProvider]:
+    """
+    Install the process-wide tracer provider for the configured exporter.
+    FastAPI picks it up on its own and opens a server span and a handler
+    span for every request, continuing the caller's traceparent. Only the
+    first call in a process does anything, since OpenTelemetry allows a
+    single global provider
+    """
+    global _provider
+    if config.exporter == "none" or _provider is not None:
+        return _provider
+
+    if config.exporter == "file":
+        exporter = JsonFileSpanExporter(config.file_path)
+    elif config.exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+
+        # Without an endpoint the exporter falls back to the standard
+        # OTEL_EXPORTER_OTLP_* environment variables
+        exporter = OTLPSpanExporter(endpoint=config.otlp_endpoint or None)
+    else:
+        raise ValueError(f"Unknown tracing exporter: {config.exporter}")
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": config.service_name})
+    )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    _provider = provider
+    logger.info(f"Exporting traces with the {config.exporter} exporter")
+    return provider
+
+
+def current_trace_ref() -> Optional[dict]:
+    """
+    Ids of the current span, to store alongside a record so later requests
+    in the same session can link back to the one that created it
+    """
+    span_context = trace.get_current_span().get_span_context()
+    if not span_context.is_valid:
+        return None
+    return {
+        "trace_id": format(span_context.trace_id, "032x"),
+        "span_id": format(span_context.span_id, "016x"),
+    }
+
+
+def link_to_record(record: dict, **attributes):
+    """
+    Link the current span to the span that created a record, and tag it with
+    the session ids (template_id, madlib_id, ...) it is working on
+    """
+    span = trace.get_current_span()
+    for name, value in attributes.items():
+        span.set_attribute(f"madlibs.{name}", value)
+    ref = record.get("trace")
+    if not ref:
+        return
+    span.add_link(
+        trace.SpanContext(
+            trace_id=int(ref["trace_id"], 16),
+            span_id=int(ref["span_id"], 16),
+            is_remote=True,
+            trace_flags=trace.TraceFlags(trace.TraceFlags.SAMPLED),
+        )
+    )
+
+
+class DSPyTracingCallback(BaseCallback):
+    """
+    Opens a span for every DSPy module (each Predict included) and LM call,
+    nested under whatever span is current when the call starts
+    """
+
+    def __init__(self):
+        self._spans = {}
+
+    def on_module_start(self, call_id, instance, inputs):
+        self._start(call_id, f"dspy.{type(instance).__name__}", {})
+
+    def on_module_end(self, call_id, outputs, exception=None):
+        self._end(call_id, exception)
+
+    def on_lm_start(self, call_id, instance, inputs):
+        self._start(call_id, "dspy.lm", {"gen_ai.request.model": instance.model})
+
+    def on_lm_end(self, call_id, outputs, exception=None):
+        self._end(call_id, exception)
+
+    def _start(self, call_id: str, name: str, attributes: dict):
+        span = tracer.start_span(name, attributes=attributes)
+        token = otel_context.attach(trace.set_span_in_context(span))
+        self._spans[call_id] = (span, token)
+
+    def _end(self, call_id: str, exception: Optional[Exception]):
+        entry = self._spans.pop(call_id, None)
+        if entry is None:
+            return
+        span, token = entry
+        if exception is not None:
+            span.record_exception(exception)
+            span.set_status(trace.StatusCode.ERROR, str(exception))
+        span.end()
+        otel_context.detach(token)
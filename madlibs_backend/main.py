@@ -5,6 +5,7 @@ import logging
 # from madlibs_module.madlibs_generator import MadLibsGenerator
 # from madlibs_module.madlibs_image import MadLibsImage
 from madlibs_module.madlibs_api import MadLibsAPI
+from madlibs_module.madlibs_config import MadLibsConfig
 
 
 def setup_logging(level=logging.INFO):
@@ -26,8 +27,31 @@ if __name__ == "__main__":
     api_key = os.environ["GOOGLE_API_KEY"]
 
     logger.info("Starting main process")
-    api = MadLibsAPI(api_key=api_key)
-    api.run()
+    config = MadLibsConfig.from_env()
+    if config.server.workers > 1:
+        import uvicorn
+
+        if config.store.backend == "memory":
+            logger.warning(
+                "Running several workers with the memory store; requests for a "
+                "template or madlib made on another worker will 404"
+            )
+        elif config.store.backend == "sqlite":
+            logger.info(
+                "Running several workers with the sqlite store; records are "
+                "written through instead of batched so every worker sees them"
+            )
+        # Each worker process builds its own MadLibsAPI through the factory
+        uvicorn.run(
+            "madlibs_module.madlibs_api:create_app",
+            factory=True,
+            host=config.server.host,
+            port=config.server.port,
+            workers=config.server.workers,
+        )
+    else:
+        api = MadLibsAPI(api_key=api_key, config=config)
+        api.run()
     # app = MadLibsGenerator(api_key=api_key)
     # # lora = MadLibsLoRA(
     # #     local_lora_path="image_model\dreamlook_trained\models\lora_ukj_style.safetensors"
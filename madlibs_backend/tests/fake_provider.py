@@ -0,0 +1,56 @@
+from typing import Optional, Sequence
+import asyncio
+import time
+
+
+class FakeProviderError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"provider answered {status_code}")
+        self.status_code = status_code
+
+
+class FakeProvider:
+    """
+    Stands in for an LM or image provider. Each call takes the next of
+    latencies (or latency once they run out) and then raises the next of
+    errors, where None means it succeeds with result. Callable like a DSPy
+    module, blocking or through acall
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latencies: Sequence[float] = (),
+        errors: Sequence[Optional[Exception]] = (),
+        result="ok",
+    ):
+        self.latency = latency
+        self.latencies = list(latencies)
+        self.errors = list(errors)
+        self.result = result
+        self.calls = 0
+
+    def _next(self):
+        self.calls += 1
+        latency = self.latencies.pop(0) if self.latencies else self.latency
+        error = self.errors.pop(0) if self.errors else None
+        return latency, error
+
+    def __call__(self, *args):
+        latency, error = self._next()
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        return self.result
+
+    async def acall(self, *args):
+        latency, error = self._next()
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        return self.result
+
+    async def attempt(self, on_start):
+        """A ResiliencePolicy call that starts straight away"""
+        on_start()
+        return await self.acall()
@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+import asyncio
+import httpx
+import pytest
+from fake_provider import FakeProvider
+from test_images import flat_png
+from madlibs_module.madlibs_image import GeneratedImage
+
+
+def make_api(tmp_path):
+    from madlibs_module.madlibs_api import MadLibsAPI
+    from madlibs_module.madlibs_config import MadLibsConfig
+
+    config = MadLibsConfig()
+    config.template_cache.enabled = False
+    config.comic_cache.enabled = False
+    config.image_cache.enabled = False
+    config.image_optimize.enabled = False
+    config.images.directory = str(tmp_path / "images")
+    api = MadLibsAPI(api_key="test", config=config)
+    generator = api.text_generator
+    generator.madlibs_generator = FakeProvider(
+        result=SimpleNamespace(
+            template="The {adjective} {noun} saw another {noun}.",
+            word_types=["adjective", "noun", "noun"],
+        )
+    )
+    generator.comicprompt_generator = FakeProvider(
+        result=SimpleNamespace(comic_prompt="A comic.", panel_suggestions="One")
+    )
+    image = FakeProvider(result=GeneratedImage(flat_png(), "image/png"))
+    api.image_generator.generate = image
+    api.image_generator.agenerate = image.acall
+    return api
+
+
+def complete(api, body):
+    async def scenario():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as c:
+            return await c.post("/api/madlib/complete", json=body)
+
+    return asyncio.run(scenario())
+
+
+def test_one_word_per_distinct_word_type(tmp_path):
+    response = complete(
+        make_api(tmp_path), {"topic": "t", "words": ["red", "fox", "unused"]}
+    )
+    assert response.status_code == 200
+    assert response.json()["madlib"]["completed_text"] == "The red fox saw another fox."
+
+
+@pytest.mark.parametrize("words", [["red"], []])
+def test_too_few_words_is_rejected(tmp_path, words):
+    api = make_api(tmp_path)
+    response = complete(api, {"topic": "t", "words": words})
+    assert response.status_code == 422
+    if words:
+        assert "adjective, noun" in response.json()["detail"]
+    # Nothing past the template was generated
+    assert api.text_generator.comicprompt_generator.calls == 0
@@ -0,0 +1,70 @@
+import asyncio
+import pytest
+from madlibs_module.madlibs_idempotency import (
+    IdempotencyKeyReusedException,
+    IdempotencyStore,
+)
+
+
+def slow_handler(result, calls):
+    async def handler():
+        calls.append(result)
+        await asyncio.sleep(0.05)
+        return result
+
+    return handler
+
+
+def test_retry_during_first_attempt_joins_it_as_a_replay():
+    store = IdempotencyStore(max_keys=10, window_seconds=60)
+    calls = []
+
+    async def scenario():
+        return await asyncio.gather(
+            store.run("submit", "k", "a", slow_handler({"id": 1}, calls)),
+            store.run("submit", "k", "a", slow_handler({"id": 2}, calls)),
+        )
+
+    (first, first_replayed), (second, second_replayed) = asyncio.run(scenario())
+    assert calls == [{"id": 1}]
+    assert first.content == second.content == {"id": 1}
+    assert (first_replayed, second_replayed) == (False, True)
+    assert store.joins == 1
+
+
+def test_different_request_during_first_attempt_is_rejected():
+    store = IdempotencyStore(max_keys=10, window_seconds=60)
+    calls = []
+
+    async def scenario():
+        first = asyncio.create_task(
+            store.run("submit", "k", "a", slow_handler({"id": 1}, calls))
+        )
+        await asyncio.sleep(0)
+        with pytest.raises(IdempotencyKeyReusedException):
+            await store.run("submit", "k", "b", slow_handler({"id": 2}, calls))
+        return await first
+
+    response, replayed = asyncio.run(scenario())
+    assert calls == [{"id": 1}]
+    assert response.content == {"id": 1} and not replayed
+    assert store.stats()["in_flight"] == 0
+
+
+def test_completed_response_is_replayed_and_mismatch_rejected():
+    store = IdempotencyStore(max_keys=10, window_seconds=60)
+    calls = []
+
+    async def scenario():
+        await store.run("submit", "k", "a", slow_handler({"id": 1}, calls))
+        replay = await store.run("submit", "k", "a", slow_handler({"id": 2}, calls))
+        with pytest.raises(IdempotencyKeyReusedException):
+            await store.run("submit", "k", "b", slow_handler({"id": 3}, calls))
+        # The same key on another route is a different request altogether
+        other = await store.run("image", "k", "b", slow_handler({"id": 4}, calls))
+        return replay, other
+
+    (replay, replayed), (other, other_replayed) = asyncio.run(scenario())
+    assert replay.content == {"id": 1} and replayed
+    assert other.content == {"id": 4} and not other_replayed
+    assert calls == [{"id": 1}, {"id": 4}]
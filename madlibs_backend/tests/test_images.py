@@ -0,0 +1,105 @@
+from io import BytesIO
+import asyncio
+import httpx
+from PIL import Image, ImageDraw
+from fake_provider import FakeProvider
+from madlibs_module.madlibs_image import GeneratedImage
+from madlibs_module.madlibs_image_processing import optimize_png
+
+
+def flat_png() -> bytes:
+    image = Image.new("RGB", (256, 256), "white")
+    draw = ImageDraw.Draw(image)
+    for index, color in enumerate(["red", "green", "blue", "yellow"]):
+        draw.rectangle([index * 48, index * 48, index * 48 + 96, 200], fill=color)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", compress_level=0)
+    return buffer.getvalue()
+
+
+class GatedProcessor:
+    """Runs image work inline, holding optimizations until the test opens the gate"""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+
+    async def run(self, fn, *args):
+        if fn is optimize_png:
+            await self.gate.wait()
+        return fn(*args)
+
+
+def make_api(tmp_path):
+    from madlibs_module.madlibs_api import MadLibsAPI
+    from madlibs_module.madlibs_config import MadLibsConfig
+
+    config = MadLibsConfig()
+    config.images.directory = str(tmp_path / "images")
+    config.image_cache.enabled = False
+    config.image_optimize.unoptimized_max_age_seconds = 30
+    api = MadLibsAPI(api_key="test", config=config)
+    provider = FakeProvider(result=GeneratedImage(flat_png(), "image/png"))
+    api.image_generator.generate = provider
+    api.image_generator.agenerate = provider.acall
+    api.image_processor = GatedProcessor()
+    return api
+
+
+def test_image_is_served_before_it_is_optimized_but_not_as_immutable(tmp_path):
+    api = make_api(tmp_path)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as c:
+            # Generating doesn't wait for the optimizer
+            result = await asyncio.wait_for(api._image_for("m1", "A story."), 5)
+            before = await c.get(result["image_url"])
+            variant = await c.get(result["image_url"], params={"w": 128})
+
+            api.image_processor.gate.set()
+            await asyncio.gather(*api._optimizations)
+            after = await c.get(result["image_url"])
+            revalidated = await c.get(
+                result["image_url"], headers={"If-None-Match": before.headers["ETag"]}
+            )
+        return before, variant, after, revalidated
+
+    before, variant, after, revalidated = asyncio.run(scenario())
+    assert before.status_code == 200
+    assert before.headers["Cache-Control"] == "public, max-age=30"
+    assert before.content == flat_png()
+    # Variants never change once made, whichever copy they were made from
+    assert variant.status_code == 200
+    assert "immutable" in variant.headers["Cache-Control"]
+
+    assert after.status_code == 200
+    assert "immutable" in after.headers["Cache-Control"]
+    assert len(after.content) < len(before.content)
+    assert after.headers["ETag"] != before.headers["ETag"]
+    assert revalidated.status_code == 200
+    assert sorted(path.name for path in (tmp_path / "images").glob("m1.*")) == [
+        "m1.png",
+        "m1.w128.png",
+    ]
+    assert api.optimization_stats["palette"] == 1
+
+
+def test_failed_optimization_publishes_the_original(tmp_path):
+    api = make_api(tmp_path)
+
+    async def fail(fn, *args):
+        raise RuntimeError("worker died")
+
+    api.image_processor.run = fail
+
+    async def scenario():
+        result = await api._image_for("m2", "A story.")
+        await asyncio.gather(*api._optimizations)
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as c:
+            return await c.get(result["image_url"])
+
+    response = asyncio.run(scenario())
+    assert response.content == flat_png()
+    assert "immutable" in response.headers["Cache-Control"]
+    assert api.optimization_stats["failed"] == 1
@@ -0,0 +1,202 @@
+from types import SimpleNamespace
+import asyncio
+import time
+import httpx
+import pytest
+from fake_provider import FakeProvider, FakeProviderError
+from madlibs_module.madlibs_executor import StageExecutor
+from madlibs_module.madlibs_resilience import (
+    CircuitBreaker,
+    CircuitOpenException,
+    ProviderTimeoutException,
+    ResiliencePolicy,
+)
+
+
+def policy(**kwargs) -> ResiliencePolicy:
+    options = dict(
+        timeout_seconds=0.2,
+        retries=2,
+        backoff_base=0.01,
+        backoff_max=0.02,
+        breaker=CircuitBreaker(failure_threshold=5, reset_seconds=0.2),
+    )
+    options.update(kwargs)
+    return ResiliencePolicy("fake", **options)
+
+
+def test_timeout_then_retry_succeeds():
+    provider = FakeProvider(latencies=[1.0, 0.01])
+    resilience = policy()
+
+    assert asyncio.run(resilience.call(provider.attempt)) == "ok"
+    assert provider.calls == 2
+    assert resilience.events["timeout"] == 1
+    assert resilience.events["retry"] == 1
+    assert resilience.breaker.state == "closed"
+
+
+def test_every_attempt_timing_out_raises():
+    provider = FakeProvider(latency=1.0)
+    resilience = policy(retries=1)
+
+    with pytest.raises(ProviderTimeoutException):
+        asyncio.run(resilience.call(provider.attempt))
+    assert provider.calls == 2
+
+
+def test_breaker_opens_then_recovers_through_half_open():
+    provider = FakeProvider(errors=[FakeProviderError(503)] * 3)
+    resilience = policy(
+        retries=0, breaker=CircuitBreaker(failure_threshold=3, reset_seconds=0.2)
+    )
+
+    async def scenario():
+        for _ in range(3):
+            with pytest.raises(FakeProviderError):
+                await resilience.call(provider.attempt)
+        assert resilience.breaker.state == "open"
+
+        # Fails fast without reaching the provider
+        with pytest.raises(CircuitOpenException) as raised:
+            await resilience.call(provider.attempt)
+        assert 0 < raised.value.retry_after <= 0.2
+        assert provider.calls == 3
+
+        await asyncio.sleep(0.25)
+        # The trial call succeeds and closes the breaker
+        assert await resilience.call(provider.attempt) == "ok"
+        assert resilience.breaker.state == "closed"
+
+    asyncio.run(scenario())
+    assert resilience.events["short_circuit"] == 1
+
+
+def test_failed_trial_call_reopens_breaker():
+    provider = FakeProvider(errors=[FakeProviderError(500)] * 2)
+    resilience = policy(
+        retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_seconds=0.1)
+    )
+
+    async def scenario():
+        with pytest.raises(FakeProviderError):
+            await resilience.call(provider.attempt)
+        await asyncio.sleep(0.15)
+        with pytest.raises(FakeProviderError):
+            await resilience.call(provider.attempt)
+
+    asyncio.run(scenario())
+    assert resilience.breaker.state == "open"
+    assert resilience.breaker.opens == 2
+
+
+@pytest.mark.parametrize("error", [FakeProviderError(400), FakeProviderError(401)])
+def test_non_transient_error_fails_without_retry(error):
+    provider = FakeProvider(errors=[error])
+    resilience = policy(breaker=CircuitBreaker(failure_threshold=1, reset_seconds=30))
+
+    with pytest.raises(FakeProviderError):
+        asyncio.run(resilience.call(provider.attempt))
+    assert provider.calls == 1
+    assert resilience.events["rejected"] == 1
+    assert resilience.events["retry"] == 0
+    assert resilience.breaker.state == "closed"
+
+
+@pytest.mark.parametrize(
+    "error", [FakeProviderError(429), FakeProviderError(502), ConnectionError()]
+)
+def test_transient_error_is_retried(error):
+    provider = FakeProvider(errors=[error])
+    resilience = policy()
+
+    assert asyncio.run(resilience.call(provider.attempt)) == "ok"
+    assert provider.calls == 2
+
+
+def test_hedge_wins_over_slow_primary():
+    # Enough fast calls to learn the p95, then a stuck primary
+    provider = FakeProvider(latencies=[0.01] * 5 + [1.0, 0.01])
+    resilience = policy(
+        timeout_seconds=2.0, hedge=True, hedge_min_delay=0.02, hedge_min_samples=5
+    )
+
+    async def scenario():
+        for _ in range(5):
+            await resilience.call(provider.attempt)
+        start = time.perf_counter()
+        assert await resilience.call(provider.attempt) == "ok"
+        return time.perf_counter() - start
+
+    assert asyncio.run(scenario()) < 0.5
+    assert resilience.events["hedge"] == 1
+    assert resilience.events["hedge_win"] == 1
+
+
+def test_unreplayable_calls_are_not_retried_or_hedged():
+    provider = FakeProvider(errors=[FakeProviderError(503)])
+    resilience = policy(hedge=True, hedge_min_samples=0)
+
+    with pytest.raises(FakeProviderError):
+        asyncio.run(resilience.call(provider.attempt, replayable=False))
+    assert provider.calls == 1
+    assert resilience.events["hedge"] == 0
+
+
+def test_time_queued_for_a_worker_does_not_count_against_the_timeout():
+    # One worker, so the last call waits for the five before it
+    stage = StageExecutor("fake", max_workers=1)
+    provider = FakeProvider(latency=0.1)
+    # The last call waits 0.5s in the queue, well past the timeout, while no
+    # call takes long enough itself to come near it
+    resilience = policy(
+        timeout_seconds=0.3,
+        retries=0,
+        breaker=CircuitBreaker(failure_threshold=1, reset_seconds=30),
+    )
+
+    async def scenario():
+        return await asyncio.gather(
+            *[
+                resilience.call(lambda on_start: stage.run(provider, on_start=on_start))
+                for _ in range(6)
+            ]
+        )
+
+    try:
+        assert asyncio.run(scenario()) == ["ok"] * 6
+    finally:
+        stage.shutdown()
+    assert resilience.events["timeout"] == 0
+    assert resilience.breaker.state == "closed"
+    # Latencies are the provider's alone, not the queue's
+    assert max(resilience._latencies) < 0.3
+
+
+def test_open_breaker_answers_503_with_retry_after():
+    from madlibs_module.madlibs_api import MadLibsAPI
+    from madlibs_module.madlibs_config import MadLibsConfig
+
+    config = MadLibsConfig()
+    config.template_cache.enabled = False
+    config.template_stage.retries = 0
+    config.template_stage.failure_threshold = 2
+    config.template_stage.reset_seconds = 30
+    api = MadLibsAPI(api_key="test", config=config)
+    provider = FakeProvider(errors=[FakeProviderError(500)] * 2)
+    provider.result = SimpleNamespace(template="The {noun}.", word_types=["noun"])
+    api.text_generator.madlibs_generator = provider
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as c:
+            statuses = [
+                (await c.post("/api/generate-template", json={"topic": "t"}))
+                for _ in range(3)
+            ]
+        return statuses
+
+    responses = asyncio.run(scenario())
+    assert [r.status_code for r in responses] == [500, 500, 503]
+    assert int(responses[2].headers["Retry-After"]) >= 29
+    assert provider.calls == 2
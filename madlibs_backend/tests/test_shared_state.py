@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+import asyncio
+import fakeredis
+import httpx
+import pytest
+import redis.asyncio
+from fake_provider import FakeProvider
+from test_images import flat_png
+from madlibs_module.madlibs_image import GeneratedImage
+from madlibs_module.madlibs_image_store import RedisImageStore
+from madlibs_module.madlibs_store import RedisRecordStore
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    """Every Redis client the app opens talks to one in-process fake server"""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.asyncio,
+        "from_url",
+        lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server),
+    )
+    return server
+
+
+def make_api():
+    from madlibs_module.madlibs_api import MadLibsAPI
+    from madlibs_module.madlibs_config import MadLibsConfig
+
+    config = MadLibsConfig()
+    config.store.backend = "redis"
+    config.images.backend = "redis"
+    config.template_cache.enabled = False
+    config.comic_cache.enabled = False
+    config.image_cache.enabled = False
+    config.image_optimize.enabled = False
+    api = MadLibsAPI(api_key="test", config=config)
+    generator = api.text_generator
+    generator.madlibs_generator = FakeProvider(
+        result=SimpleNamespace(template="The {noun} ran.", word_types=["noun"])
+    )
+    generator.comicprompt_generator = FakeProvider(
+        result=SimpleNamespace(comic_prompt="A comic.", panel_suggestions="One")
+    )
+    image = FakeProvider(result=GeneratedImage(flat_png(), "image/png"))
+    api.image_generator.generate = image
+    api.image_generator.agenerate = image.acall
+    return api
+
+
+def test_workers_sharing_redis_serve_each_others_records_and_images(redis_server):
+    first, second = make_api(), make_api()
+
+    async def scenario():
+        clients = [
+            httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=api.app), base_url="http://t"
+            )
+            for api in (first, second)
+        ]
+        async with clients[0] as a, clients[1] as b:
+            template = await a.post("/api/generate-template", json={"topic": "t"})
+            madlib = await b.post(
+                "/api/submit-madlib",
+                json={
+                    "template_id": template.json()["template_id"],
+                    "user_inputs": {"noun": "dog"},
+                },
+            )
+            image = await a.post(
+                "/api/generate-image", json={"madlib_id": madlib.json()["madlib_id"]}
+            )
+            return madlib, await b.get(image.json()["image_url"])
+
+    madlib, image = asyncio.run(scenario())
+    assert madlib.status_code == 200
+    assert madlib.json()["completed_text"] == "The dog ran."
+    assert image.status_code == 200
+    assert image.content == flat_png()
+    # Each step ran once, on whichever worker got it
+    assert first.text_generator.madlibs_generator.calls == 1
+    assert second.text_generator.comicprompt_generator.calls == 1
+    assert first.image_generator.generate.calls == 1
+
+
+def test_records_and_images_expire(redis_server):
+    records = RedisRecordStore("test", "redis://fake", max_items=0, ttl_seconds=1)
+    images = RedisImageStore("redis://fake", ttl_seconds=1)
+
+    async def scenario():
+        await records.put("a", {"n": 1})
+        await images.write("a.png", b"png")
+        assert await records.get("a") == {"n": 1}
+        assert await images.exists("a.png")
+        await asyncio.sleep(1.1)
+        # A later write drops the expired record's index entry too
+        await records.put("b", {"n": 2})
+        stats = await records.stats()
+        return await records.get("a"), await images.read("a.png"), stats
+
+    record, image, stats = asyncio.run(scenario())
+    assert record is None and image is None
+    assert stats["size"] == 1
+
+
+def test_least_recently_used_records_are_evicted(redis_server):
+    store = RedisRecordStore("test", "redis://fake", max_items=2, ttl_seconds=0)
+
+    async def scenario():
+        await store.put("a", {"n": 1})
+        await store.put("b", {"n": 2})
+        await store.get("a")
+        await store.put("c", {"n": 3})
+        return [await store.get(key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(scenario()) == [{"n": 1}, None, {"n": 3}]
+    assert store.evictions == 1
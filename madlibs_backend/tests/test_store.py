@@ -0,0 +1,64 @@
+import asyncio
+import sqlite3
+import pytest
+from madlibs_module.madlibs_store import SQLiteRecordStore
+
+
+def make_store(tmp_path, **kwargs) -> SQLiteRecordStore:
+    options = dict(max_items=0, ttl_seconds=0, batch_size=100, flush_interval=60)
+    options.update(kwargs)
+    return SQLiteRecordStore("test", str(tmp_path / "store.db"), **options)
+
+
+def test_buffered_records_are_served_while_a_flush_holds_the_connection(tmp_path):
+    store = make_store(tmp_path)
+
+    async def scenario():
+        await store.put("a", {"n": 1})
+        # As if the flusher thread were in the middle of a long transaction
+        with store._conn_lock:
+            await asyncio.wait_for(store.put("b", {"n": 2}), 1)
+            return await asyncio.wait_for(store.get("a"), 1)
+
+    assert asyncio.run(scenario()) == {"n": 1}
+    asyncio.run(store.close())
+
+
+def test_flushed_records_are_read_back(tmp_path):
+    store = make_store(tmp_path)
+
+    async def scenario():
+        await store.put("a", {"n": 1})
+        await asyncio.to_thread(store.flush)
+        assert store._pending == {}
+        found = await store.get("a")
+        stats = await store.stats()
+        await store.delete("a")
+        return found, stats, await store.get("a")
+
+    found, stats, deleted = asyncio.run(scenario())
+    assert found == {"n": 1}
+    assert stats["size"] == 1 and stats["pending_writes"] == 0
+    assert deleted is None
+    asyncio.run(store.close())
+
+
+def test_failed_flush_keeps_the_batch(tmp_path):
+    store = make_store(tmp_path)
+
+    def fail(pending, touched):
+        store._conn.execute("BEGIN")
+        raise sqlite3.OperationalError("database is locked")
+
+    async def scenario():
+        await store.put("a", {"n": 1})
+        store._write_batch, write_batch = fail, store._write_batch
+        with pytest.raises(sqlite3.OperationalError):
+            await asyncio.to_thread(store.flush)
+        store._write_batch = write_batch
+        assert "a" in store._pending
+        await asyncio.to_thread(store.flush)
+        return await store.get("a")
+
+    assert asyncio.run(scenario()) == {"n": 1}
+    asyncio.run(store.close())